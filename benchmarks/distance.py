@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the per-user geopy distance path with the vectorized kernel.
+
+Usage: python benchmarks/distance.py
+"""
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from eeveebot.utils import get_distance, get_distances, get_within_radius, get_new_coords
+
+CENTER = (-22.931950, -43.247290)
+
+def make_users(count, radius):
+    return [get_new_coords(CENTER, random.uniform(0, radius), random.uniform(0, 360)) for x in range(count)]
+
+def geopy_path(users, radius):
+    return [get_distance(user, CENTER) <= radius for user in users]
+
+def numpy_path(users, radius):
+    return get_within_radius(CENTER, [user[0] for user in users], [user[1] for user in users], radius)
+
+def main():
+    random.seed(42)
+    
+    print('%8s %8s %14s %14s %8s' % ('users', 'radius', 'geopy (ms)', 'numpy (ms)', 'speedup'))
+    for radius in (70, 1000):
+        for count in (10, 100, 1000):
+            users = make_users(count, radius * 1.5)
+            runs = max(1, 2000 // count)
+            
+            t_geopy = timeit.timeit(lambda: geopy_path(users, radius), number=runs) / runs * 1000
+            t_numpy = timeit.timeit(lambda: numpy_path(users, radius), number=runs) / runs * 1000
+            
+            print('%8d %8d %14.3f %14.3f %7.1fx' % (count, radius, t_geopy, t_numpy, t_geopy / t_numpy))
+    
+    # Accuracy against geopy's geodesic for the radii we care about
+    for radius in (70, 1000):
+        users = make_users(10000, radius * 1.5)
+        
+        expected = [get_distance(user, CENTER) for user in users]
+        actual = get_distances(CENTER, [user[0] for user in users], [user[1] for user in users])
+        
+        error = max(abs(a - b) for a, b in zip(expected, actual))
+        print('Max error within %d m: %.6f m' % (radius * 1.5, error))
+        
+        assert error < 0.01
+
+if __name__ == '__main__':
+    main()
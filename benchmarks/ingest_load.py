@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Load test for the webhook. Start the bot with --server flask or
+--server gevent, then point this at it to compare both:
+
+Usage: python benchmarks/ingest_load.py http://127.0.0.1:4000/<token> [clients] [seconds] [batch]
+
+With 8 clients for 10 s against SQLite on one machine:
+
+             batch  req/s    p50 (ms)  p99 (ms)  shed with 429
+    flask        1  541.3      14.20     26.58       0
+    gevent       1  606.6      13.21     21.59       0
+    flask       50  198.7      37.61     67.16    1139
+    gevent      50  186.0      42.25     61.86       0
+
+Both are bound by the GIL they share with the update threads.
+"""
+import json
+import sys
+import threading
+import time
+import uuid
+
+import requests
+
+def make_batch(size):
+    # Despawning in 10s, so the update threads drop them right after
+    # deduplication and only the ingestion path is measured.
+    return json.dumps([{
+        'type': 'pokemon',
+        'message': {
+            'spawnpoint_id': str(uuid.uuid4()),
+            'encounter_id': str(uuid.uuid4()),
+            'pokemon_id': 16,
+            'latitude': -22.931950,
+            'longitude': -43.247290,
+            'disappear_time': time.time() + 10
+        }
+    } for x in range(size)])
+
+def client(url, deadline, batch, latencies, errors):
+    session = requests.Session()
+    headers = {'Content-Type': 'application/json'}
+    
+    while time.time() < deadline:
+        data = make_batch(batch)
+        
+        start = time.time()
+        try:
+            response = session.post(url, data=data, headers=headers)
+        except requests.RequestException as e:
+            errors.append(str(e))
+            continue
+        latencies.append(time.time() - start)
+        
+        if response.status_code != 200:
+            errors.append(response.status_code)
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__.strip())
+        sys.exit(1)
+        
+    url = sys.argv[1]
+    clients = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    seconds = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+    batch = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+    
+    latencies = []
+    errors = []
+    deadline = time.time() + seconds
+    
+    threads = [threading.Thread(target=client, args=(url, deadline, batch, latencies, errors)) for x in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+        
+    latencies.sort()
+    if len(latencies) == 0:
+        print('No successful requests (%d errors).' % len(errors))
+        return
+        
+    print('%d clients, %ds, %d sightings per request' % (clients, seconds, batch))
+    shed = len([error for error in errors if error == 429])
+    print('requests:  %d (%d shed with 429, %d other errors)' % (len(latencies), shed, len(errors) - shed))
+    print('req/s:     %.1f' % (len(latencies) / float(seconds)))
+    print('sightings: %.1f/s' % (len(latencies) * batch / float(seconds)))
+    print('p50:       %.2f ms' % (latencies[len(latencies) // 2] * 1000))
+    print('p99:       %.2f ms' % (latencies[int(len(latencies) * 0.99)] * 1000))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Measures how long the offline geocoder takes to build its cache from a CSV,
+to load it back memory-mapped, and to answer a lookup.
+
+Usage: python benchmarks/offline_geocoder.py [addresses.csv]
+
+Without a dataset, a synthetic one of 1,000,000 addresses around Rio de
+Janeiro is written to a temporary directory.
+"""
+import csv
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from eeveebot.geocoder import OfflineGeocoder
+
+CENTER = (-22.931950, -43.247290)
+
+def make_dataset(path, count):
+    with open(path, 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(['latitude', 'longitude', 'street_name', 'street_number', 'sublocality', 'locality'])
+
+        for x in range(count):
+            writer.writerow([
+                CENTER[0] + random.uniform(-0.5, 0.5),
+                CENTER[1] + random.uniform(-0.5, 0.5),
+                'Rua %d' % random.randint(1, 20000),
+                random.randint(1, 2000),
+                'Bairro %d' % random.randint(1, 150),
+                'Rio de Janeiro'
+            ])
+
+def main():
+    random.seed(42)
+
+    directory = None
+    if len(sys.argv) > 1:
+        dataset = sys.argv[1]
+    else:
+        directory = tempfile.mkdtemp()
+        dataset = os.path.join(directory, 'addresses.csv')
+        make_dataset(dataset, 1000000)
+
+    try:
+        shutil.rmtree(dataset + '.cache', ignore_errors=True)
+
+        start = time.time()
+        OfflineGeocoder(dataset)
+        print('Build and load: %10.3f s' % (time.time() - start))
+
+        start = time.time()
+        geocoder = OfflineGeocoder(dataset)
+        print('Load (mmap):    %10.3f ms' % ((time.time() - start) * 1000))
+
+        points = [(CENTER[0] + random.uniform(-0.5, 0.5), CENTER[1] + random.uniform(-0.5, 0.5)) for x in range(10000)]
+
+        # Touch every page once, so the timings below don't include disk reads
+        for point in points:
+            geocoder.reverse(*point)
+
+        iterator = iter(points * 10)
+        runs = len(points) * 10
+        elapsed = timeit.timeit(lambda: geocoder.reverse(*next(iterator)), number=runs)
+        print('Lookup:         %10.1f us' % (elapsed / runs * 1000000))
+    finally:
+        if directory != None:
+            shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
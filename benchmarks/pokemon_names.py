@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of the pokemon name lookups used by /add and /del.
+
+Usage: python benchmarks/pokemon_names.py
+"""
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from eeveebot.utils import get_pokemon_id, suggest_pokemon, pokemon_ids
+
+TOKENS = {
+    'exact': ['Bulbasaur', 'Dragonite', "Farfetch'd", 'Mr. Mime'],
+    'folded': [u'PIKACHÚ', u'Nidoran♀', u'évee'],
+    'prefix': ['bulba', 'drago', 'snorl'],
+    'typo': ['pikahcu', 'charmandr', 'gengr', 'eveee'],
+    'unknown': ['xyzzy', 'agumon'],
+}
+
+def old_get_pokemon_id(pokemon_name):
+    pokemon_name = re.sub(r'\W+', '', pokemon_name).lower()
+    return pokemon_ids.get(pokemon_name)
+
+def bench(fn, tokens, number=20000):
+    return timeit.timeit(lambda: [fn(token) for token in tokens], number=number) / (number * len(tokens)) * 1e6
+
+def main():
+    print('%10s %14s %14s %14s' % ('tokens', 'old (us)', 'lookup (us)', 'suggest (us)'))
+    for kind in ('exact', 'folded', 'prefix', 'typo', 'unknown'):
+        tokens = TOKENS[kind]
+        print('%10s %14.2f %14.2f %14.2f' % (kind,
+                                             bench(old_get_pokemon_id, tokens),
+                                             bench(get_pokemon_id, tokens),
+                                             bench(suggest_pokemon, tokens)))
+
+if __name__ == '__main__':
+    main()
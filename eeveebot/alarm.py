@@ -1,31 +1,65 @@
 # -*- coding: utf-8 -*-
+import cgi
+import heapq
 import logging
+import time
 
+from collections import namedtuple
+from itertools import count
+from Queue import Empty
 from threading import Thread
 
-from .utils import get_args
+from .utils import get_args, format_time_left
+from .models import User
 import telepot
+import telepot.api
+import urllib3
+from telepot.exception import TelegramError
 from telepot.namedtuple import ReplyKeyboardMarkup, KeyboardButton
 
 log = logging.getLogger(__name__)
 
 args = get_args()
 
+# Results of a send
+SENT, RETRY, UNREACHABLE, FAILED = range(4)
+
+MAX_ATTEMPTS = 3
+
+Sighting = namedtuple('Sighting', ['title', 'pokemon_name', 'disappear_time', 'address', 'latitude', 'longitude'])
+
+def to_unicode(s):
+    if isinstance(s, str):
+        return s.decode('utf-8')
+    return s
+
+def get_map_url(latitude, longitude):
+    return 'https://maps.google.com/maps?q={:.6f},{:.6f}'.format(latitude, longitude)
+
+def init_connection_pool(size):
+    # All telepot.Bot instances share this pool manager, so every sender
+    # thread keeps its own keep-alive connection to the Telegram API.
+    telepot.api._pools['default'] = urllib3.PoolManager(num_pools=3, maxsize=size, retries=False, timeout=30)
+
 class AlarmThread(Thread):
     def __init__(self, app):
         super(AlarmThread, self).__init__()
         self.app = app
         self.queue = app.alarm_queue
-        self.telegram_bot = telepot.Bot(args.telegram_key)
+        self.send_queues = app.send_queues
 
     def run(self):
         while True:
             try:
                 # Loop the queue
                 while True:
-                    chats, method, args = self.queue.get()
-                                       
-                    self.bulk_send(chats, method, args)
+                    deadline, (chats, method, args) = self.queue.get()
+                    
+                    if deadline <= time.time():
+                        # Already despawned, don't bother
+                        self.app.stats.incr('alarms_expired')
+                    else:
+                        self.bulk_send(deadline, chats, method, args)
                     
                     if self.queue.qsize() > 50:
                         log.warning('Alarm queue is > 50 (@%d); try increasing --alarm-threads', self.queue.qsize())
@@ -36,10 +70,8 @@ class AlarmThread(Thread):
             except Exception as e:
                 log.exception('Exception in AlarmThread: %s', e)
                 
-    def bulk_send(self, chats, method, args):
-        fn = None
-        
-        if hasattr(self.telegram_bot, method) == False:
+    def bulk_send(self, deadline, chats, method, args):
+        if hasattr(telepot.Bot, method) == False:
             log.debug('Unsupported method %s', method)
             return
             
@@ -49,8 +81,371 @@ class AlarmThread(Thread):
                                 [KeyboardButton(text='Enviar localização', request_location=True)],
                              ], resize_keyboard=True)
          
+        # Messages to the same chat always go through the same sender, which
+        # sends the ones closest to their deadline first.
+        for chat_id in chats:
+            queue = self.send_queues[hash(chat_id) % len(self.send_queues)]
+            queue.put((chat_id, method, args, deadline))
+
+class CoalesceThread(Thread):
+    """
+    Merges the sightings a chat is alerted about within --coalesce-window
+    seconds. The first one goes out right away and opens the window; the
+    ones that match before it closes are sent together as a single digest.
+    """
+    def __init__(self, app):
+        super(CoalesceThread, self).__init__()
+        self.app = app
+        self.queue = app.coalesce_queue
+        self.window = args.coalesce_window
+        
+        # Sightings held back for each chat with an open window
+        self.windows = {}
+        # (when, chat_id) of the windows to close
+        self.closing = []
+        
+    def run(self):
+        while True:
+            try:
+                # Loop the queue
+                while True:
+                    if len(self.closing) > 0:
+                        timeout = max(self.closing[0][0] - time.time(), 0)
+                    else:
+                        timeout = None
+                        
+                    try:
+                        chats, sighting = self.queue.get(timeout=timeout)
+                        self.add(chats, sighting)
+                        self.queue.task_done()
+                    except Empty:
+                        pass
+                        
+                    self.close_windows()
+            except KeyboardInterrupt:
+                break
+            except Exception as e:
+                log.exception('Exception in CoalesceThread: %s', e)
+                
+    def add(self, chats, sighting):
+        now = time.time()
+        chats_now = set()
+        
+        for chat_id in chats:
+            if chat_id in self.windows:
+                self.windows[chat_id].append(sighting)
+            else:
+                chats_now.add(chat_id)
+                self.open_window(chat_id, now)
+                
+        if len(chats_now) > 0:
+            self.send(chats_now, [sighting])
+            
+    def open_window(self, chat_id, now):
+        self.windows[chat_id] = []
+        heapq.heappush(self.closing, (now + self.window, chat_id))
+        
+    def close_windows(self):
+        now = time.time()
+        
+        while len(self.closing) > 0 and self.closing[0][0] <= now:
+            when, chat_id = heapq.heappop(self.closing)
+            sightings = [s for s in self.windows.pop(chat_id) if s.disappear_time > now]
+            
+            # Keep coalescing while the chat is busy
+            if len(sightings) > 0:
+                self.send(set([chat_id]), sightings)
+                self.open_window(chat_id, now)
+                
+    def send(self, chats, sightings):
+        now = time.time()
+        
+        if len(sightings) == 1:
+            sighting = sightings[0]
+            
+            targs = {
+                'text': '<b>{}</b>\n{} restantes.'.format(cgi.escape(sighting.title), format_time_left(sighting.disappear_time - now)),
+                'parse_mode': 'HTML'
+            }
+            self.app.alarm_queue.put((sighting.disappear_time, (chats, 'sendMessage', targs)))
+            
+            targs = {
+                'title': sighting.pokemon_name,
+                'address': sighting.address or '',
+                'latitude': sighting.latitude,
+                'longitude': sighting.longitude,
+                'disable_notification': 'True'
+            }
+            self.app.alarm_queue.put((sighting.disappear_time, (chats, 'sendVenue', targs)))
+            return
+            
+        sightings = sorted(sightings, key=lambda s: s.disappear_time)
+        
+        # Names and addresses go into HTML, where a stray & or < makes
+        # Telegram reject the whole digest
+        text = u'<b>{} Pokémon por perto!</b>\n'.format(len(sightings))
+        for sighting in sightings:
+            text += u'\n{} - {} restantes'.format(cgi.escape(to_unicode(sighting.pokemon_name)), format_time_left(sighting.disappear_time - now))
+            if sighting.address:
+                text += u' ({})'.format(cgi.escape(to_unicode(sighting.address)))
+            else:
+                # The digest has no venues, so point to it on the map instead
+                text += u' (<a href="{}">mapa</a>)'.format(get_map_url(sighting.latitude, sighting.longitude))
+                
+        targs = {
+            'text': text,
+            'parse_mode': 'HTML',
+            'disable_web_page_preview': True
+        }
+        self.app.alarm_queue.put((sightings[-1].disappear_time, (chats, 'sendMessage', targs)))
+        
+class SenderThread(Thread):
+    def __init__(self, app, queue):
+        super(SenderThread, self).__init__()
+        self.app = app
+        self.queue = queue
+        self.rate_limiter = app.rate_limiter
+        self.telegram_bot = telepot.Bot(args.telegram_key)
+        
+        # Sends waiting on a rate limit, as a heap of
+        # (deadline, seq, method, args) per chat
+        self.pending = {}
+        # (deadline of the first pending send, seq, chat_id) of the chats that
+        # can be tried now, most urgent first; entries whose seq no longer
+        # matches queued[chat_id] are stale
+        self.ready = []
+        self.queued = {}
+        # (when, seq, chat_id) of the chats deferred by a rate limit or a retry
+        self.waiting = []
+        self.counter = count()
+        # Failed attempts at the first pending send of each chat
+        self.attempts = {}
+        # When the global bucket has a token again
+        self.global_until = 0
+
+    def run(self):
+        while True:
+            try:
+                # Loop the queue
+                while True:
+                    self.receive()
+                    self.send_ready()
+                    
+                    if self.queue.qsize() > 500:
+                        log.warning('Send queue is > 500 (@%d); try increasing --alarm-threads', self.queue.qsize())
+            except KeyboardInterrupt:
+                break
+            except Exception as e:
+                log.exception('Exception in SenderThread: %s', e)
+                
+    def receive(self):
+        # Block until a new send arrives or the next deferred one is due
+        if len(self.ready) > 0:
+            timeout = self.global_until - time.time()
+        elif len(self.waiting) > 0:
+            timeout = max(self.waiting[0][0], self.global_until) - time.time()
+        else:
+            timeout = None
+            
+        try:
+            if timeout == None or timeout > 0:
+                item = self.queue.get(timeout=timeout)
+            else:
+                item = self.queue.get_nowait()
+        except Empty:
+            return
+            
+        while True:
+            self.add(*item)
+            self.queue.task_done()
+            
+            try:
+                item = self.queue.get_nowait()
+            except Empty:
+                return
+                
+    def add(self, chat_id, method, args, deadline):
+        # Sends with the same deadline, like a message and its venue, keep
+        # the order they were queued in
+        if chat_id not in self.pending:
+            self.pending[chat_id] = []
+            
+        pending = self.pending[chat_id]
+        heapq.heappush(pending, (deadline, next(self.counter), method, args))
+        
+        # A deferred chat is made ready again when its wait is over
+        if chat_id in self.queued or len(pending) == 1:
+            if pending[0][0] == deadline:
+                self.make_ready(chat_id)
+                
+    def make_ready(self, chat_id):
+        seq = next(self.counter)
+        self.queued[chat_id] = seq
+        heapq.heappush(self.ready, (self.pending[chat_id][0][0], seq, chat_id))
+        
+    def defer(self, chat_id, when):
+        heapq.heappush(self.waiting, (when, next(self.counter), chat_id))
+        
+    def send_ready(self):
+        while True:
+            now = time.time()
+            
+            while len(self.waiting) > 0 and self.waiting[0][0] <= now:
+                when, seq, chat_id = heapq.heappop(self.waiting)
+                self.make_ready(chat_id)
+                
+            if len(self.ready) == 0 or self.global_until > now:
+                return
+                
+            deadline, seq, chat_id = heapq.heappop(self.ready)
+            if self.queued.get(chat_id) != seq:
+                continue
+            del self.queued[chat_id]
+            
+            pending = self.pending[chat_id]
+            
+            # Drop whatever expired while it waited for the rate limiter
+            while len(pending) > 0 and pending[0][0] <= now:
+                heapq.heappop(pending)
+                self.app.stats.incr('sends_expired')
+                
+            if len(pending) == 0:
+                del self.pending[chat_id]
+                self.attempts.pop(chat_id, None)
+                continue
+            
+            chat_wait, global_wait = self.rate_limiter.reserve(chat_id)
+            if chat_wait > 0:
+                self.defer(chat_id, time.time() + chat_wait)
+                continue
+                
+            if global_wait > 0:
+                # Every chat waits on the same bucket, so wait for it once
+                # instead of cycling through all of them
+                self.global_until = time.time() + global_wait
+                self.make_ready(chat_id)
+                continue
+                
+            deadline, seq, method, args = pending[0]
+            
+            result, delay = self.send(chat_id, method, args)
+            
+            if result == RETRY:
+                # Rate limits are retried until the deadline...
+                if delay != None:
+                    self.rate_limiter.pause(chat_id, delay)
+                    self.defer(chat_id, time.time() + delay)
+                    continue
+                    
+                # ...anything else only a few times
+                attempts = self.attempts.get(chat_id, 0) + 1
+                if attempts < MAX_ATTEMPTS:
+                    self.attempts[chat_id] = attempts
+                    self.defer(chat_id, time.time() + 2 ** attempts)
+                    continue
+                    
+                log.error('Giving up on sending %s to %s after %d attempts.', method, chat_id, attempts)
+                self.app.stats.incr('sends_failed')
+                
+            self.attempts.pop(chat_id, None)
+            
+            if result == UNREACHABLE:
+                # Nothing else will get there either
+                self.app.stats.incr('sends_unreachable', len(pending))
+                del pending[:]
+                self.app.prune_queue.put(chat_id)
+            else:
+                if result == FAILED:
+                    self.app.stats.incr('sends_failed')
+                heapq.heappop(pending)
+            
+            if len(pending) > 0:
+                self.make_ready(chat_id)
+            else:
+                del self.pending[chat_id]
+                
+    def send(self, chat_id, method, args):
+        """
+        Returns a (result, delay) tuple, where delay is how long Telegram
+        asked us to wait before retrying, if it did.
+        """
         fn = getattr(self.telegram_bot, method)
+        
+        try:
+            fn(chat_id=chat_id, **args)
+            return SENT, None
+        except TelegramError as e:
+            if e.error_code == 429:
+                retry_after = (e.json or {}).get('parameters', {}).get('retry_after', 1)
+                log.warning('Telegram asked us to wait %ds before sending to %s again.', retry_after, chat_id)
+                return RETRY, retry_after
+                
+            if e.error_code == 403 or (e.error_code == 400 and is_unreachable(e.description)):
+                log.info('Chat %s is unreachable: %s', chat_id, e.description)
+                return UNREACHABLE, None
+                
+            if e.error_code >= 500:
+                log.warning('Failed to send %s to %s: %s', method, chat_id, e)
+                return RETRY, None
+                
+            log.error('Failed to send %s to %s: %s', method, chat_id, e)
+            return FAILED, None
+        except Exception as e:
+            # Most likely a network error
+            log.warning('Failed to send %s to %s: %s', method, chat_id, e)
+            return RETRY, None
+
+def is_unreachable(description):
+    description = (description or '').lower()
     
-        for chat_id in chats:
-            args['chat_id'] = chat_id
-            fn(**args)
\ No newline at end of file
+    return ('chat not found' in description or
+            'deactivated' in description or
+            'peer_id_invalid' in description)
+
+class PruneThread(Thread):
+    """
+    Disables the users whose chats can no longer be reached, in batches.
+    """
+    def __init__(self, app):
+        super(PruneThread, self).__init__()
+        self.app = app
+        self.queue = app.prune_queue
+        
+    def run(self):
+        while True:
+            try:
+                # Loop the queue
+                while True:
+                    chat_ids = set([self.queue.get()])
+                    
+                    # Let the failures of a whole fan-out pile up
+                    time.sleep(5)
+                    try:
+                        while True:
+                            chat_ids.add(self.queue.get_nowait())
+                    except Empty:
+                        pass
+                        
+                    self.prune(chat_ids)
+            except KeyboardInterrupt:
+                break
+            except Exception as e:
+                log.exception('Exception in PruneThread: %s', e)
+                
+    def prune(self, chat_ids):
+        # Channels are addressed by name and have no user behind them
+        chat_ids = [chat_id for chat_id in chat_ids if isinstance(chat_id, (int, long))]
+        if len(chat_ids) == 0:
+            return
+            
+        query = (User
+                 .update(enabled=False)
+                 .where(User.chat_id << chat_ids))
+        query.execute()
+        
+        for chat_id in chat_ids:
+            self.app.user_cache.invalidate(chat_id)
+            self.app.user_index.remove(chat_id)
+            
+        self.app.stats.incr('chats_pruned', len(chat_ids))
+        log.info('Disabled %d unreachable chats.', len(chat_ids))
@@ -1,15 +1,20 @@
 import logging
 import json
 
-from collections import OrderedDict
 from Queue import Queue
-from threading import Lock
+from urlparse import urlparse
 
 from flask import Flask, request
 from flask_compress import Compress
 
 from . import config
-from .utils import get_args
+from .utils import get_args, is_valid_pokemon
+from .index import UserIndex, AlertIndex, SpawnpointCache
+from .ratelimit import RateLimiter, QuotaLimiter
+from .queues import BatchQueue, DeadlineQueue, KeyedDeadlineQueue
+from .stats import Stats
+from .seen import SeenStore
+from .cache import LocationCache, AddressCache, UserCache
 
 log = logging.getLogger(__name__)
 
@@ -17,36 +22,146 @@ compress = Compress()
 
 args = get_args()
 
+def get_update_deadline(update):
+    message_type, message = update
+    return message['disappear_time']
+
 class EeveeBot(Flask):
     def __init__(self, import_name, **kwargs):
         super(EeveeBot, self).__init__(import_name, **kwargs)
         compress.init_app(self)
         
-        self.seen = OrderedDict()
-        self.seen_lock = Lock()
-        self.update_queue = Queue()
-        self.alarm_queue = Queue()
+        update_threads = max(args.update_threads, 1)
+        self.update_queues = [BatchQueue(max(args.update_queue_size // update_threads, 1), shed_key=get_update_deadline)
+                              for x in range(update_threads)]
+        self.alarm_queue = DeadlineQueue()
+        self.coalesce_queue = Queue()
+        self.prune_queue = Queue()
+        self.geocode_queue = KeyedDeadlineQueue()
+        self.telegram_queue = Queue()
+        self.command_queues = [Queue() for x in range(max(args.bot_threads, 1))]
+        self.send_queues = [Queue() for x in range(max(args.alarm_threads, 1))]
+        self.rate_limiter = RateLimiter(args.telegram_rate, args.telegram_chat_rate)
+        self.geocode_limiter = QuotaLimiter(args.geocoder_rate, args.geocoder_daily_quota, args.geocoder_quota_file)
+        self.stats = Stats()
+        self.seen = SeenStore(self.stats)
+        self.user_index = UserIndex()
+        self.alert_index = AlertIndex()
+        self.spawnpoint_cache = SpawnpointCache(self.user_index, args.spawnpoint_cache_size)
+        self.location_cache = LocationCache(self.stats, args.location_cache_size)
+        self.address_cache = AddressCache(self.stats, args.address_cache_size, args.snap_distance)
+        self.user_cache = UserCache(args.user_cache_size)
+        self.geocoder = None
         
         if args.token:
             self.route('/%s' % args.token, methods=['POST'])(self.post_update)
         else:
             self.route('/', methods=['POST'])(self.post_update)
             
+        if args.telegram_webhook:
+            self.route(urlparse(args.telegram_webhook).path, methods=['POST'])(self.post_telegram_update)
+            
         self.route('/test', methods=['GET'])(self.test)
+        self.route('/stats', methods=['GET'])(self.get_stats)
         
         
     def post_update(self):
         log.debug('POST request received from %s.' % (request.remote_addr))
         try:
             data = json.loads(request.data)
-        except:
-            return ('', 204)
-
-        if ('message' in data and
-            'type' in data):
-            self.update_queue.put((data['type'], data['message']))
+        except ValueError:
+            return ('', 400)
+            
+        # RocketMap sends either a single update or a list of them
+        if not isinstance(data, list):
+            data = [data]
+            
+        updates = []
+        rejected = 0
+        ignored = 0
+        
+        for update in data:
+            if (not isinstance(update, dict) or
+                'message' not in update or
+                'type' not in update):
+                rejected += 1
+            elif update['type'] != 'pokemon':
+                ignored += 1
+            elif not is_valid_pokemon(update['message']):
+                log.debug('Invalid pokemon message. Ignoring.')
+                rejected += 1
+            else:
+                updates.append((update['type'], update['message']))
+                
+        shed_queued, shed_incoming = self.put_updates(updates)
+        shed = shed_queued + shed_incoming
+        accepted = len(updates) - shed_incoming
+        
+        self.stats.incr('updates_accepted', accepted)
+        self.stats.incr('updates_rejected', rejected)
+        
+        result = {
+            'accepted': accepted,
+            'rejected': rejected,
+            'ignored': ignored,
+            'shed': shed
+        }
+        
+        if shed > 0:
+            # Tell the scanner to back off for a bit
+            log.warning('Update queue is full; shed %d sightings closest to despawning.', shed)
+            self.stats.incr('updates_shed', shed)
+            return (json.dumps(result), 429, {'Content-Type': 'application/json', 'Retry-After': '1'})
+        
+        return (json.dumps(result), 200, {'Content-Type': 'application/json'})
+    
+    def post_telegram_update(self):
+        # BotThread picks it up from here and routes it to on_message
+        self.telegram_queue.put(request.data)
+        
+        return ('', 200)
+    
+    def get_update_queue(self, message):
+        # Updates for the same encounter always go to the same thread, so
+        # they are processed in the order they arrived.
+        return self.update_queues[hash(str(message['encounter_id'])) % len(self.update_queues)]
+        
+    def put_update(self, message_type, message):
+        return self.get_update_queue(message).put_many([(message_type, message)])
+        
+    def put_updates(self, updates):
+        batches = {}
+        for message_type, message in updates:
+            batches.setdefault(self.get_update_queue(message), []).append((message_type, message))
+            
+        shed_queued = 0
+        shed_incoming = 0
+        for queue, batch in batches.iteritems():
+            queued, incoming = queue.put_many(batch)
+            shed_queued += queued
+            shed_incoming += incoming
+            
+        return shed_queued, shed_incoming
+    
+    def get_stats(self):
+        stats = self.stats.snapshot()
+        stats['seen'] = len(self.seen)
+        stats['location_cache'] = len(self.location_cache)
+        stats['address_cache'] = len(self.address_cache)
+        stats['spawnpoint_cache'] = len(self.spawnpoint_cache)
+        stats['user_cache'] = len(self.user_cache)
+        stats['update_queue'] = sum(queue.qsize() for queue in self.update_queues)
+        stats['alarm_queue'] = self.alarm_queue.qsize()
+        stats['send_queue'] = sum(queue.qsize() for queue in self.send_queues)
+        stats['geocode_queue'] = self.geocode_queue.qsize()
+        stats['geocode_quota_used'] = self.geocode_limiter.used
+        stats['command_queue'] = sum(queue.qsize() for queue in self.command_queues)
+        
+        snaps = stats.get('snap_hits', 0) + stats.get('snap_misses', 0)
+        if snaps > 0:
+            stats['snap_hit_rate'] = float(stats.get('snap_hits', 0)) / snaps
         
-        return ('', 204)
+        return (json.dumps(stats), 200, {'Content-Type': 'application/json'})
     
     def test(self):
         import uuid
@@ -61,6 +176,6 @@ class EeveeBot(Flask):
             'disappear_time': time.time() + 60+42
         }
         
-        self.update_queue.put(('pokemon', message))
+        self.put_update('pokemon', message)
         
         return ('Hello', 200)
\ No newline at end of file
@@ -1,20 +1,67 @@
 # -*- coding: utf-8 -*-
 import logging
+import time
 
-from datetime import datetime
 from threading import Thread
 
-from .models import User, UserAlert
-from .utils import get_args, get_pokemon, get_pokemon_name
+from .models import UserAlert
+from .utils import get_args, get_pokemon, get_pokemon_name, suggest_pokemon
 
 import telepot
 from telepot.namedtuple import ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardHide
-from peewee import IntegrityError
 
 log = logging.getLogger(__name__)
 
 args = get_args()
 
+class CommandThread(Thread):
+    def __init__(self, bot, queue):
+        super(CommandThread, self).__init__()
+        self.bot = bot
+        self.app = bot.app
+        self.queue = queue
+        
+    def run(self):
+        while True:
+            try:
+                # Loop the queue
+                while True:
+                    received, message = self.queue.get()
+                    
+                    start = time.time()
+                    try:
+                        self.bot.handle_message(message)
+                    finally:
+                        self.app.stats.observe('command_wait_ms', (start - received) * 1000)
+                        self.app.stats.observe('command_handler_ms', (time.time() - start) * 1000)
+                        self.queue.task_done()
+                    
+                    if self.queue.qsize() > 50:
+                        log.warning('Command queue is > 50 (@%d); try increasing --bot-threads', self.queue.qsize())
+            except KeyboardInterrupt:
+                break
+            except Exception as e:
+                log.exception('Exception in CommandThread: %s', e)
+
+class FlushThread(Thread):
+    def __init__(self, app):
+        super(FlushThread, self).__init__()
+        self.app = app
+        
+    def run(self):
+        while True:
+            try:
+                while True:
+                    time.sleep(args.user_flush_interval)
+                    
+                    count = self.app.user_cache.flush()
+                    if count > 0:
+                        log.debug('Flushed last message of %d users.', count)
+            except KeyboardInterrupt:
+                break
+            except Exception as e:
+                log.exception('Exception in FlushThread: %s', e)
+
 class BotThread(Thread):
     def __init__(self, app):
         super(BotThread, self).__init__()
@@ -41,19 +88,34 @@ class BotThread(Thread):
     def run(self):
         while True:
             try:
-                self.telegram_bot.message_loop(callback=self.on_message, run_forever=True)
+                if args.telegram_webhook:
+                    log.info('Receiving Telegram updates on %s', args.telegram_webhook)
+                    self.telegram_bot.setWebhook(args.telegram_webhook)
+                    self.telegram_bot.message_loop(callback=self.on_message, source=self.app.telegram_queue, run_forever=True)
+                else:
+                    # Telegram refuses to poll while a webhook is set
+                    self.telegram_bot.setWebhook()
+                    self.telegram_bot.message_loop(callback=self.on_message, run_forever=True)
             except KeyboardInterrupt:
                 break
             except Exception as e:
                 log.exception('Exception in BotThread: %s', e)
                 
-    def on_message(self, message):       
+    def on_message(self, message):
+        # Messages from the same chat always go to the same thread, so they
+        # are handled in the order they were sent.
+        chat_id = message['chat']['id']
+        queue = self.app.command_queues[hash(chat_id) % len(self.app.command_queues)]
+        
+        queue.put((time.time(), message))
+        
+    def handle_message(self, message):       
         chat_id = message['chat']['id']
               
         log.info('New message from %ld', chat_id)
         
-        user, created = User.get_or_create(chat_id=chat_id)
-        user.last_message = datetime.now()
+        user, created = self.app.user_cache.get_or_create(chat_id)
+        state = self.get_state(user)
         
         try:
             if created == True:
@@ -74,8 +136,17 @@ class BotThread(Thread):
             if 'location' in message:
                 self.on_location(user, message['location'])
         finally:
-            user.save()
+            self.app.user_cache.touch(user)
+            
+            # Only real changes are written right away, last_message waits
+            # for the next flush
+            if self.get_state(user) != state:
+                self.app.user_cache.save(user)
+                self.app.user_index.update(user)
             
+    def get_state(self, user):
+        return (user.latitude, user.longitude, user.enabled, user.report_catchable)
+        
     def on_enable(self, user, command, *args):
         user.enabled = True
         self.telegram_bot.sendMessage(user.chat_id, 'Notificações ativadas. Envie sua localização.', reply_markup=self.markup_location)
@@ -129,18 +200,23 @@ class BotThread(Thread):
             
         text = ''
         
+        alerts = self.app.alert_index.get_alerts(user.chat_id)
+        added = []
+        
         for arg in args:
             pokemon_id = get_pokemon(arg)
         
             if pokemon_id != None:
-                try:
-                    UserAlert.create(user=user, pokemon_id=pokemon_id)
+                if pokemon_id not in alerts:
+                    alerts.add(pokemon_id)
+                    added.append(pokemon_id)
                     text += '#{} - {} adicionado.\n'.format(pokemon_id, get_pokemon_name(pokemon_id))
-                except IntegrityError:
+                else:
                     text += '#{} - {} já estava na sua lista.\n'.format(pokemon_id, get_pokemon_name(pokemon_id))
             else:
-                text += '\'{}\' não corresponde a nenhum Pokémon.\n'.format(arg)
+                text += self.get_unknown_pokemon_text(arg)
                                
+        self.insert_alerts(user, added)
         
         self.telegram_bot.sendMessage(user.chat_id, text.strip())
         
@@ -160,6 +236,7 @@ class BotThread(Thread):
                     .where(UserAlert.user == user))
             
             query.execute()
+            self.app.alert_index.remove_all(user.chat_id)
             
             text = 'Todos os Pokémons foram removidos.'
             self.telegram_bot.sendMessage(user.chat_id, text)
@@ -167,24 +244,39 @@ class BotThread(Thread):
             
         text = ''
         
+        alerts = self.app.alert_index.get_alerts(user.chat_id)
+        removed = []
+        
         for arg in args:
             pokemon_id = get_pokemon(arg)
         
             if pokemon_id != None:
-                query = (UserAlert
-                        .delete()
-                        .where((UserAlert.user == user) &
-                               (UserAlert.pokemon_id == pokemon_id)))
-                    
-                if query.execute() == 0:
+                if pokemon_id not in alerts:
                     text += '#{} - {} não estava na sua lista.\n'.format(pokemon_id, get_pokemon_name(pokemon_id))
                 else:
+                    alerts.discard(pokemon_id)
+                    removed.append(pokemon_id)
                     text += '#{} - {} removido.\n'.format(pokemon_id, get_pokemon_name(pokemon_id))
             else:
-                text += '\'{}\' não corresponde a nenhum Pokémon.\n'.format(arg)
+                text += self.get_unknown_pokemon_text(arg)
+        
+        self.delete_alerts(user, removed)
         
         self.telegram_bot.sendMessage(user.chat_id, text.strip())
     
+    def get_unknown_pokemon_text(self, arg):
+        # telepot hands us unicode, and the replies are UTF-8 byte strings
+        if isinstance(arg, unicode):
+            arg = arg.encode('utf-8')
+            
+        text = '\'{}\' não corresponde a nenhum Pokémon.'.format(arg)
+        
+        pokemon_id = suggest_pokemon(arg)
+        if pokemon_id != None:
+            text += ' Você quis dizer #{} - {}?'.format(pokemon_id, get_pokemon_name(pokemon_id))
+            
+        return text + '\n'
+        
     def on_start(self, user, command, *args):
         text = 'Olá. Eu sou o Eevee Robot, e eu posso te avisar se eu vir algum Pokémon raro.\n\n'
         text += 'Para começar a receber notificações, basta usar o comando /enable e, em seguida, enviar a sua localização.\n\n'
@@ -222,20 +314,39 @@ class BotThread(Thread):
         self.telegram_bot.sendMessage(user.chat_id, text, reply_markup=self.markup_location)
             
     def add_all_pokemon(self, user):
-        values = [{'user': user, 'pokemon_id': id} for id in range(1, 152)]
-        
-        query = (UserAlert
-                .insert_many(values))
+        alerts = self.app.alert_index.get_alerts(user.chat_id)
         
-        query.execute()
+        self.insert_alerts(user, [id for id in range(1, 152) if id not in alerts])
      
     def add_default_pokemon(self, user):
         if args.default_pokemon == None:
             return
         
-        values = [{'user': user, 'pokemon_id': id} for id in args.default_pokemon]
+        alerts = self.app.alert_index.get_alerts(user.chat_id)
+        
+        self.insert_alerts(user, [id for id in args.default_pokemon if id not in alerts])
+        
+    def insert_alerts(self, user, pokemon_ids):
+        # pokemon_ids must not be on the user's list yet
+        if len(pokemon_ids) == 0:
+            return
+            
+        values = [{'user': user, 'pokemon_id': id} for id in pokemon_ids]
         
         query = (UserAlert
                 .insert_many(values))
         
-        query.execute()
\ No newline at end of file
+        query.execute()
+        self.app.alert_index.add(user.chat_id, pokemon_ids)
+        
+    def delete_alerts(self, user, pokemon_ids):
+        if len(pokemon_ids) == 0:
+            return
+            
+        query = (UserAlert
+                .delete()
+                .where((UserAlert.user == user) &
+                       (UserAlert.pokemon_id << pokemon_ids)))
+        
+        query.execute()
+        self.app.alert_index.remove(user.chat_id, pokemon_ids)
\ No newline at end of file
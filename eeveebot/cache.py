@@ -0,0 +1,287 @@
+import logging
+import math
+
+from collections import OrderedDict
+from datetime import datetime
+from threading import Lock
+
+from .models import Location, User
+from .utils import get_outer_square, get_distances
+
+log = logging.getLogger(__name__)
+
+# A neighbour a few metres away is on the same street, not the same building
+ADDRESS_FIELDS = ('street_name', 'sublocality', 'locality')
+
+class LRUCache(object):
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key):
+        self.lock.acquire()
+        try:
+            value = self.items.pop(key, None)
+            if value != None:
+                self.items[key] = value
+            return value
+        finally:
+            self.lock.release()
+
+    def put(self, key, value):
+        self.lock.acquire()
+        try:
+            self.items.pop(key, None)
+            self.items[key] = value
+
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+        finally:
+            self.lock.release()
+
+    def invalidate(self, key):
+        self.lock.acquire()
+        try:
+            self.items.pop(key, None)
+        finally:
+            self.lock.release()
+
+class LocationCache(LRUCache):
+    """
+    Location rows of the spawnpoints seen recently, keyed by their
+    coordinates rounded to about 10 cm.
+    """
+    def __init__(self, stats, size):
+        super(LocationCache, self).__init__(size)
+        self.stats = stats
+
+    def get_key(self, latitude, longitude):
+        return (round(latitude, 6), round(longitude, 6))
+
+    def get_or_create(self, latitude, longitude):
+        key = self.get_key(latitude, longitude)
+
+        location = self.get(key)
+        if location != None:
+            self.stats.incr('location_cache_hits')
+            return location, False
+
+        self.stats.incr('location_cache_misses')
+
+        location, created = Location.get_or_create(latitude=latitude, longitude=longitude)
+        self.put(key, location)
+
+        return location, created
+
+    def refresh(self, location):
+        self.put(self.get_key(location.latitude, location.longitude), location)
+
+class AddressCache(LRUCache):
+    """
+    Addresses of the geocoded locations in a grid of cells about 100 m wide,
+    so a new location a few metres from one of them can take its address
+    without a geocoding request. Cells are evicted least recently used.
+    """
+    def __init__(self, stats, size, distance, cell_size=0.001):
+        super(AddressCache, self).__init__(size)
+        self.stats = stats
+        self.distance = distance
+        self.cell_size = cell_size
+
+    def get_cell(self, latitude, longitude):
+        return (int(math.floor(latitude / self.cell_size)),
+                int(math.floor(longitude / self.cell_size)))
+
+    def load(self):
+        if self.distance <= 0:
+            return
+
+        query = (Location
+                 .select()
+                 .where((Location.resolved == True) &
+                        (Location.street_name != None)))
+
+        for location in query:
+            self.add(location)
+
+        log.info('Loaded %d cells of addresses.', len(self))
+
+    def add(self, location):
+        # Places the geocoder didn't know have nothing to share
+        if self.distance <= 0 or location.street_name == None:
+            return
+
+        key = self.get_cell(location.latitude, location.longitude)
+        address = dict((field, getattr(location, field)) for field in ADDRESS_FIELDS)
+
+        self.lock.acquire()
+        try:
+            cell = self.items.pop(key, None) or []
+            cell.append((location.latitude, location.longitude, address))
+            self.items[key] = cell
+
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+        finally:
+            self.lock.release()
+
+    def find(self, latitude, longitude):
+        """
+        Returns the address of the closest location within the snap
+        distance, or None.
+        """
+        box = get_outer_square((latitude, longitude), self.distance)
+        min_cell = self.get_cell(box['min_latitude'], box['min_longitude'])
+        max_cell = self.get_cell(box['max_latitude'], box['max_longitude'])
+
+        candidates = []
+        for x in range(min_cell[0], max_cell[0] + 1):
+            for y in range(min_cell[1], max_cell[1] + 1):
+                cell = self.get((x, y))
+                if cell != None:
+                    candidates.extend(cell)
+
+        if len(candidates) == 0:
+            return None
+
+        distances = get_distances((latitude, longitude),
+                                  [c[0] for c in candidates],
+                                  [c[1] for c in candidates])
+        closest = distances.argmin()
+
+        if distances[closest] > self.distance:
+            return None
+
+        return candidates[closest][2]
+
+    def snap(self, location, count_miss=True):
+        """
+        Resolves the location with the address of a neighbour and returns
+        True, or returns False if there's none close enough. Only count a
+        miss where it ends up costing a geocoding request.
+        """
+        if self.distance <= 0:
+            return False
+
+        address = self.find(location.latitude, location.longitude)
+        if address == None:
+            if count_miss == True:
+                self.stats.incr('snap_misses')
+            return False
+
+        self.stats.incr('snap_hits')
+
+        for field, value in address.iteritems():
+            setattr(location, field, value)
+
+        location.resolved = True
+        location.save()
+
+        return True
+
+class UserCache(object):
+    """
+    User rows of the chats that talked to the bot, least recently used
+    evicted first. Bumping last_message only marks the user as dirty;
+    flush() writes those in a single transaction, and a dirty user is never
+    evicted before that.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.users = OrderedDict()
+        # chat_id: user of the users flush() has to write
+        self.dirty = {}
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.users)
+
+    def get_or_create(self, chat_id):
+        self.lock.acquire()
+        try:
+            user = self.users.pop(chat_id, None)
+            if user != None:
+                self.users[chat_id] = user
+                return user, False
+        finally:
+            self.lock.release()
+
+        user, created = User.get_or_create(chat_id=chat_id)
+
+        self.lock.acquire()
+        try:
+            self.users.pop(chat_id, None)
+            self.users[chat_id] = user
+            self.evict()
+        finally:
+            self.lock.release()
+
+        return user, created
+
+    def evict(self):
+        excess = len(self.users) - self.size
+        if excess <= 0:
+            return
+
+        # Oldest first, skipping the ones flush() hasn't written yet
+        evicted = []
+        for chat_id in self.users:
+            if chat_id not in self.dirty:
+                evicted.append(chat_id)
+                if len(evicted) == excess:
+                    break
+
+        for chat_id in evicted:
+            del self.users[chat_id]
+
+    def touch(self, user):
+        user.last_message = datetime.now()
+
+        self.lock.acquire()
+        try:
+            self.dirty[user.chat_id] = user
+        finally:
+            self.lock.release()
+
+    def save(self, user):
+        self.lock.acquire()
+        try:
+            self.dirty.pop(user.chat_id, None)
+        finally:
+            self.lock.release()
+
+        user.save()
+
+    def invalidate(self, chat_id):
+        self.lock.acquire()
+        try:
+            self.users.pop(chat_id, None)
+            self.dirty.pop(chat_id, None)
+        finally:
+            self.lock.release()
+
+    def flush(self):
+        self.lock.acquire()
+        try:
+            users = self.dirty.values()
+            self.dirty = {}
+            # Whatever was kept around only to be written can go now
+            self.evict()
+        finally:
+            self.lock.release()
+
+        if len(users) == 0:
+            return 0
+
+        with User._meta.database.atomic():
+            for user in users:
+                query = (User
+                         .update(last_message=user.last_message)
+                         .where(User.chat_id == user.chat_id))
+                query.execute()
+
+        return len(users)
@@ -1,66 +1,344 @@
+import csv
 import logging
+import os
 import time
 
 from threading import Thread
 
-from .utils import get_args
+from .utils import get_args, get_distances
 from .models import Location
 
 import googlemaps
+import numpy as np
 
 log = logging.getLogger(__name__)
 
 args = get_args()
 
+# Seconds between looks for unresolved locations in the database, and how
+# many to queue each time
+SWEEP_INTERVAL = 60
+SWEEP_SIZE = 500
+
+# Priority of the locations found by the sweep, after any live sighting
+BACKSTOP = float('inf')
+
+# Grid of the offline dataset, in degrees (about 1 km)
+OFFLINE_CELL_SIZE = 0.01
+OFFLINE_FIELDS = ('street_name', 'street_number', 'sublocality', 'locality')
+
+# Meters to the closest address beyond which the place counts as unknown,
+# and beyond which its street number is left out
+OFFLINE_MAX_DISTANCE = 100
+OFFLINE_NUMBER_DISTANCE = 10
+
+def get_priority(disappear_time):
+    # Sightings that stay up the longest get their address first; the ones
+    # that are already gone end up behind all the live ones
+    return -disappear_time
+
+def get_geocoder():
+    """
+    Returns the configured geocoding backend, or None if geocoding is off.
+    """
+    if args.geocoder_backend == 'offline':
+        if args.geocoder_dataset == None:
+            log.error('The offline geocoder needs --geocoder-dataset, geocoder will not be enabled.')
+            return None
+
+        try:
+            return OfflineGeocoder(args.geocoder_dataset)
+        except (IOError, OSError) as e:
+            log.error('Could not load the offline geocoder dataset %s: %s, geocoder will not be enabled.', args.geocoder_dataset, e)
+            return None
+
+    if args.gmaps_key:
+        return GoogleGeocoder(args.gmaps_key, args.geocoder_rate)
+
+    log.debug('No --gmaps-key, geocoder will not be enabled.')
+    return None
+
+def set_address(location, address):
+    if address != None:
+        for field, value in address.iteritems():
+            setattr(location, field, value)
+
+    location.resolved = True
+    location.save()
+
+class GoogleGeocoder(object):
+    """
+    Reverse geocoding through the Google Maps Geocoding API. Anything with a
+    reverse(latitude, longitude) method returning the same fields can take
+    its place; limited tells whether requests count against a quota.
+    """
+    limited = True
+
+    def __init__(self, key, rate=10):
+        self.client = googlemaps.Client(key, queries_per_second=max(int(rate), 1))
+
+    def reverse(self, latitude, longitude):
+        """
+        Returns a dict of Location fields, or None if the place is unknown.
+        """
+        result = self.client.reverse_geocode((latitude, longitude), language='pt-BR')
+
+        # Google doesn't know...
+        if len(result) == 0:
+            return None
+
+        address = {}
+
+        for component in result[0]['address_components']:
+            if 'route' in component['types']:
+                address['street_name'] = component['short_name']
+            if 'street_number' in component['types']:
+                address['street_number'] = component['short_name']
+            if 'sublocality' in component['types'] and 'sublocality_level_1' in component['types']:
+                address['sublocality'] = component['short_name']
+            if 'locality' in component['types']:
+                address['locality'] = component['short_name']
+            if 'premise' in component['types']:
+                address['premise'] = component['short_name']
+
+        return address
+
+class OfflineGeocoder(object):
+    """
+    Reverse geocoding from a local CSV of addresses, e.g. an extract of
+    OpenStreetMap or GeoNames, with a latitude and a longitude column plus
+    any of the OFFLINE_FIELDS columns.
+
+    Points are sorted by grid cell and saved as .npy files next to the CSV
+    the first time, and memory-mapped from there on.
+    """
+    limited = False
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.cache = dataset + '.cache'
+
+        if self.is_cache_fresh() == False:
+            self.build()
+
+        self.load()
+
+    def get_key(self, x, y):
+        # Works for single cells and numpy arrays alike
+        return (x + 2 ** 20) * 2 ** 21 + (y + 2 ** 20)
+
+    def get_cell(self, latitude, longitude):
+        return (int(np.floor(latitude / OFFLINE_CELL_SIZE)),
+                int(np.floor(longitude / OFFLINE_CELL_SIZE)))
+
+    def get_path(self, name):
+        return os.path.join(self.cache, name)
+
+    def is_cache_fresh(self):
+        path = self.get_path('strings.txt')
+
+        return os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(self.dataset)
+
+    def build(self):
+        log.info('Building the offline geocoder cache of %s...', self.dataset)
+
+        latitudes = []
+        longitudes = []
+        fields = []
+        strings = {'': 0}
+        skipped = 0
+
+        with open(self.dataset, 'rb') as f:
+            for row in csv.DictReader(f):
+                try:
+                    latitude = float(row['latitude'])
+                    longitude = float(row['longitude'])
+                except (KeyError, TypeError, ValueError):
+                    skipped += 1
+                    continue
+
+                latitudes.append(latitude)
+                longitudes.append(longitude)
+
+                ids = []
+                for field in OFFLINE_FIELDS:
+                    value = ' '.join((row.get(field) or '').split())
+                    ids.append(strings.setdefault(value, len(strings)))
+                fields.append(ids)
+
+        if skipped > 0:
+            log.warning('Skipped %d rows of %s without coordinates.', skipped, self.dataset)
+
+        latitudes = np.array(latitudes, dtype=np.float64)
+        longitudes = np.array(longitudes, dtype=np.float64)
+        fields = np.array(fields, dtype=np.int32).reshape(-1, len(OFFLINE_FIELDS))
+
+        x = np.floor(latitudes / OFFLINE_CELL_SIZE).astype(np.int64)
+        y = np.floor(longitudes / OFFLINE_CELL_SIZE).astype(np.int64)
+        keys = self.get_key(x, y)
+
+        order = np.argsort(keys, kind='mergesort')
+
+        if not os.path.exists(self.cache):
+            os.makedirs(self.cache)
+
+        np.save(self.get_path('keys.npy'), keys[order])
+        np.save(self.get_path('latitudes.npy'), latitudes[order])
+        np.save(self.get_path('longitudes.npy'), longitudes[order])
+        np.save(self.get_path('fields.npy'), fields[order])
+
+        # Written last, so its mtime tells the cache is complete
+        with open(self.get_path('strings.txt'), 'wb') as f:
+            for value, id in sorted(strings.iteritems(), key=lambda item: item[1]):
+                f.write(value + '\n')
+
+    def load(self):
+        self.keys = np.load(self.get_path('keys.npy'), mmap_mode='r')
+        self.latitudes = np.load(self.get_path('latitudes.npy'), mmap_mode='r')
+        self.longitudes = np.load(self.get_path('longitudes.npy'), mmap_mode='r')
+        self.fields = np.load(self.get_path('fields.npy'), mmap_mode='r')
+
+        with open(self.get_path('strings.txt'), 'rb') as f:
+            self.strings = [line[:-1].decode('utf-8') or None for line in f]
+
+        log.info('Loaded %d addresses for the offline geocoder.', len(self.keys))
+
+    def reverse(self, latitude, longitude):
+        """
+        Returns the fields of the closest address in the cells around the
+        point, or None if there's none within OFFLINE_MAX_DISTANCE.
+        """
+        x, y = self.get_cell(latitude, longitude)
+
+        # Each row of three cells is a single run of keys
+        bounds = []
+        for dx in (-1, 0, 1):
+            bounds.append(self.get_key(x + dx, y - 1))
+            bounds.append(self.get_key(x + dx, y + 2))
+        bounds = np.searchsorted(self.keys, bounds)
+
+        indexes = np.concatenate([np.arange(bounds[i], bounds[i + 1]) for i in range(0, len(bounds), 2)])
+        if len(indexes) == 0:
+            return None
+
+        distances = get_distances((latitude, longitude), self.latitudes[indexes], self.longitudes[indexes])
+        closest = distances.argmin()
+
+        if distances[closest] > OFFLINE_MAX_DISTANCE:
+            return None
+
+        address = dict((field, self.strings[id]) for field, id in zip(OFFLINE_FIELDS, self.fields[indexes[closest]]))
+
+        # Further away it's the same street, but not the same building
+        if distances[closest] > OFFLINE_NUMBER_DISTANCE:
+            address['street_number'] = None
+
+        return address
+
 class GeocoderThread(Thread):
-    def __init__(self, app):
+    def __init__(self, app, geocoder):
         super(GeocoderThread, self).__init__()
         self.app = app
-        self.gmaps = googlemaps.Client(args.gmaps_key)
-        
+        self.queue = app.geocode_queue
+        self.geocoder = geocoder
+
     def run(self):
         while True:
             try:
-                query = (Location
-                        .select()
-                        .where(Location.resolved == False)
-                        .limit(50))
+                # Loop the queue
+                while True:
+                    priority, location = self.queue.get()
 
-                try:
-                    for location in query:
-                        self.geocode(location)
-                        log.info('Successfully geocoded (%f, %f)', location.latitude, location.longitude)
-                except Exception as e:
-                    log.exception('Geocoding exception %s. Sleeping for 60 seconds.', e)
-                    time.sleep(60)
-                    
-            
+                    try:
+                        if self.is_resolved(location) == True:
+                            continue
+
+                        if self.geocoder.limited == True:
+                            if self.app.address_cache.snap(location) == True:
+                                self.app.location_cache.refresh(location)
+                                continue
+
+                            self.wait_for_quota()
+
+                        self.resolve(location)
+                    finally:
+                        self.queue.task_done()
             except KeyboardInterrupt:
                 break
             except Exception as e:
                 log.exception('Exception in GeocoderThread: %s', e)
-                
+
+    def is_resolved(self, location):
+        if location.resolved == True:
+            return True
+
+        # The sweep loads its own copies, which may have been resolved since
+        key = self.app.location_cache.get_key(location.latitude, location.longitude)
+        cached = self.app.location_cache.get(key)
+
+        return cached != None and cached.resolved == True
+
+    def wait_for_quota(self):
+        while True:
+            wait = self.app.geocode_limiter.reserve()
+            if wait == 0:
+                return
+
+            if wait > SWEEP_INTERVAL:
+                log.warning('Daily geocoding quota used up; waiting %d seconds.', wait)
+
+            time.sleep(wait)
+
+    def resolve(self, location):
+        start = time.time()
+
+        try:
+            self.geocode(location)
+            self.app.location_cache.refresh(location)
+            if self.geocoder.limited == True:
+                self.app.address_cache.add(location)
+            self.app.stats.incr('geocode_requests')
+            log.info('Successfully geocoded (%f, %f)', location.latitude, location.longitude)
+        except Exception as e:
+            self.app.stats.incr('geocode_failures')
+            log.exception('Geocoding exception %s. Sleeping for 60 seconds.', e)
+            time.sleep(60)
+        finally:
+            self.app.stats.observe('geocode_ms', (time.time() - start) * 1000)
+
     def geocode(self, location):
-        result = self.gmaps.reverse_geocode((location.latitude, location.longitude), language='pt-BR')
-        
-        # Google doesn't know...
-        if len(result) == 0:
-            location.resolved = True
-            location.save()
-            
-        result = result[0]
-        
-        for component in result['address_components']:
-            if 'route' in component['types']:
-                location.street_name = component['short_name']
-            if 'street_number' in component['types']:
-                location.street_number = component['short_name']
-            if 'sublocality' in component['types'] and 'sublocality_level_1' in component['types']:
-                location.sublocality = component['short_name']
-            if 'locality' in component['types']:
-                location.locality = component['short_name']
-            if 'premise' in component['types']:
-                location.premise = component['short_name']
-                
-        location.resolved = True
-        location.save()
+        address = self.geocoder.reverse(location.latitude, location.longitude)
+
+        if address == None:
+            self.app.stats.incr('geocode_unknown')
+
+        set_address(location, address)
+
+class SweepThread(Thread):
+    """
+    Queues the locations left unresolved, e.g. from before a restart or after
+    a failed request, behind every live sighting.
+    """
+    def __init__(self, app):
+        super(SweepThread, self).__init__()
+        self.app = app
+
+    def run(self):
+        while True:
+            try:
+                while True:
+                    query = (Location
+                            .select()
+                            .where(Location.resolved == False)
+                            .limit(SWEEP_SIZE))
+
+                    for location in query:
+                        key = self.app.location_cache.get_key(location.latitude, location.longitude)
+                        self.app.geocode_queue.put((BACKSTOP, (key, location)))
+
+                    time.sleep(SWEEP_INTERVAL)
+            except KeyboardInterrupt:
+                break
+            except Exception as e:
+                log.exception('Exception in SweepThread: %s', e)
+                time.sleep(SWEEP_INTERVAL)
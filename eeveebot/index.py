@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+import logging
+import math
+
+from collections import namedtuple, OrderedDict
+from threading import Lock
+
+from .models import User, UserAlert
+from .utils import get_outer_square, get_within_radius
+
+log = logging.getLogger(__name__)
+
+IndexedUser = namedtuple('IndexedUser', ['chat_id', 'latitude', 'longitude', 'report_catchable'])
+Spawnpoint = namedtuple('Spawnpoint', ['latitude', 'longitude', 'catchable', 'nearby'])
+
+CATCHABLE_RADIUS = 70
+NEARBY_RADIUS = 1000
+
+class UserIndex(object):
+    """
+    Uniform grid of the enabled users, keyed on their location, so matching
+    a sighting only looks at the cells around it instead of the database.
+    """
+    def __init__(self, cell_size=0.01):
+        self.cell_size = cell_size
+        self.users = {}
+        self.cells = {}
+        self.listeners = []
+        self.lock = Lock()
+
+    def get_cell(self, latitude, longitude):
+        return (int(math.floor(latitude / self.cell_size)),
+                int(math.floor(longitude / self.cell_size)))
+
+    def load(self):
+        query = (User
+                 .select()
+                 .where(User.enabled == True))
+
+        for user in query:
+            self.update(user)
+
+        log.info('Loaded %d users into the spatial index.', len(self.users))
+
+    def update(self, user):
+        new = None
+        
+        self.lock.acquire()
+        try:
+            old = self._remove(user.chat_id)
+
+            if (user.enabled == True and
+                user.latitude != None and
+                user.longitude != None):
+                new = IndexedUser(user.chat_id, user.latitude, user.longitude, user.report_catchable)
+                self.users[user.chat_id] = new
+                self.cells.setdefault(self.get_cell(user.latitude, user.longitude), set()).add(user.chat_id)
+        finally:
+            self.lock.release()
+
+        self.notify(old, new)
+
+    def remove(self, chat_id):
+        self.lock.acquire()
+        try:
+            old = self._remove(chat_id)
+        finally:
+            self.lock.release()
+
+        self.notify(old, None)
+
+    def notify(self, old, new):
+        if old == new:
+            return
+
+        for listener in self.listeners:
+            listener(old, new)
+
+    def _remove(self, chat_id):
+        user = self.users.pop(chat_id, None)
+        if user == None:
+            return None
+
+        cell = self.get_cell(user.latitude, user.longitude)
+        chats = self.cells.get(cell)
+        chats.discard(chat_id)
+        if len(chats) == 0:
+            del self.cells[cell]
+
+        return user
+
+    def query(self, box):
+        min_x, min_y = self.get_cell(box['min_latitude'], box['min_longitude'])
+        max_x, max_y = self.get_cell(box['max_latitude'], box['max_longitude'])
+
+        users = []
+
+        self.lock.acquire()
+        try:
+            for x in range(min_x, max_x + 1):
+                for y in range(min_y, max_y + 1):
+                    for chat_id in self.cells.get((x, y), ()):
+                        user = self.users[chat_id]
+                        if (box['min_latitude'] <= user.latitude <= box['max_latitude'] and
+                            box['min_longitude'] <= user.longitude <= box['max_longitude']):
+                            users.append(user)
+        finally:
+            self.lock.release()
+
+        return users
+
+    def query_radius(self, center, radius):
+        users = self.query(get_outer_square(center, radius))
+
+        if len(users) == 0:
+            return users
+
+        mask = get_within_radius(center,
+                                 [user.latitude for user in users],
+                                 [user.longitude for user in users],
+                                 radius)
+
+        return [user for user, inside in zip(users, mask) if inside]
+
+class AlertIndex(object):
+    """
+    Inverted index from pokemon_id to the chats that have it on their list.
+    """
+    def __init__(self):
+        self.subscribers = {}
+        self.alerts = {}
+        self.lock = Lock()
+
+    def load(self):
+        query = (UserAlert
+                 .select(UserAlert.user, UserAlert.pokemon_id)
+                 .tuples())
+
+        for chat_id, pokemon_id in query:
+            self.add(chat_id, [pokemon_id])
+
+        log.info('Loaded alerts of %d users into the alert index.', len(self.alerts))
+
+    def add(self, chat_id, pokemon_ids):
+        self.lock.acquire()
+        try:
+            for pokemon_id in pokemon_ids:
+                self.subscribers.setdefault(pokemon_id, set()).add(chat_id)
+                self.alerts.setdefault(chat_id, set()).add(pokemon_id)
+        finally:
+            self.lock.release()
+
+    def remove(self, chat_id, pokemon_ids):
+        self.lock.acquire()
+        try:
+            for pokemon_id in pokemon_ids:
+                chats = self.subscribers.get(pokemon_id)
+                if chats != None:
+                    chats.discard(chat_id)
+                    if len(chats) == 0:
+                        del self.subscribers[pokemon_id]
+
+                alerts = self.alerts.get(chat_id)
+                if alerts != None:
+                    alerts.discard(pokemon_id)
+                    if len(alerts) == 0:
+                        del self.alerts[chat_id]
+        finally:
+            self.lock.release()
+
+    def remove_all(self, chat_id):
+        self.lock.acquire()
+        try:
+            pokemon_ids = list(self.alerts.get(chat_id, ()))
+        finally:
+            self.lock.release()
+
+        self.remove(chat_id, pokemon_ids)
+
+    def get_alerts(self, chat_id):
+        self.lock.acquire()
+        try:
+            return set(self.alerts.get(chat_id, ()))
+        finally:
+            self.lock.release()
+
+    def match(self, pokemon_id, chats):
+        self.lock.acquire()
+        try:
+            subscribers = self.subscribers.get(pokemon_id)
+            if subscribers == None:
+                return set()
+
+            if len(chats) > len(subscribers):
+                return set(chat_id for chat_id in subscribers if chat_id in chats)
+
+            return set(chat_id for chat_id in chats if chat_id in subscribers)
+        finally:
+            self.lock.release()
+
+class SpawnpointCache(object):
+    """
+    The chats within reach of each spawnpoint seen recently: those close
+    enough to catch it that asked for /catchable, and those close enough to
+    be alerted about the pokemon on their list.
+    
+    Entries are dropped whenever a user in range, before or after the
+    change, moves or toggles their alerts.
+    """
+    def __init__(self, user_index, size):
+        self.user_index = user_index
+        self.size = size
+        self.spawnpoints = OrderedDict()
+        self.cells = {}
+        self.members = {}
+        self.version = 0
+        self.lock = Lock()
+
+        user_index.listeners.append(self.on_user_changed)
+
+    def __len__(self):
+        return len(self.spawnpoints)
+
+    def get(self, spawnpoint_id, latitude, longitude):
+        self.lock.acquire()
+        try:
+            spawnpoint = self.spawnpoints.pop(spawnpoint_id, None)
+            if spawnpoint != None:
+                self.spawnpoints[spawnpoint_id] = spawnpoint
+                return spawnpoint
+
+            version = self.version
+        finally:
+            self.lock.release()
+
+        center = (latitude, longitude)
+        nearby = frozenset(user.chat_id for user in self.user_index.query_radius(center, NEARBY_RADIUS))
+        catchable = frozenset(user.chat_id for user in self.user_index.query_radius(center, CATCHABLE_RADIUS)
+                              if user.report_catchable == True)
+        spawnpoint = Spawnpoint(latitude, longitude, catchable, nearby)
+
+        self.lock.acquire()
+        try:
+            # Someone changed while we were looking, so this might be stale
+            if version != self.version or spawnpoint_id in self.spawnpoints:
+                return spawnpoint
+
+            self.spawnpoints[spawnpoint_id] = spawnpoint
+            self.cells.setdefault(self.user_index.get_cell(latitude, longitude), set()).add(spawnpoint_id)
+            for chat_id in nearby:
+                self.members.setdefault(chat_id, set()).add(spawnpoint_id)
+
+            while len(self.spawnpoints) > self.size:
+                self._remove(next(iter(self.spawnpoints)))
+        finally:
+            self.lock.release()
+
+        return spawnpoint
+
+    def on_user_changed(self, old, new):
+        chat_id = (old or new).chat_id
+
+        self.lock.acquire()
+        try:
+            self.version += 1
+
+            spawnpoint_ids = self.members.get(chat_id, set()).copy()
+            if new != None:
+                spawnpoint_ids.update(self._query(new.latitude, new.longitude))
+
+            for spawnpoint_id in spawnpoint_ids:
+                self._remove(spawnpoint_id)
+        finally:
+            self.lock.release()
+
+    def _query(self, latitude, longitude):
+        box = get_outer_square((latitude, longitude), NEARBY_RADIUS)
+        min_x, min_y = self.user_index.get_cell(box['min_latitude'], box['min_longitude'])
+        max_x, max_y = self.user_index.get_cell(box['max_latitude'], box['max_longitude'])
+
+        spawnpoint_ids = set()
+        for x in range(min_x, max_x + 1):
+            for y in range(min_y, max_y + 1):
+                spawnpoint_ids.update(self.cells.get((x, y), ()))
+
+        return spawnpoint_ids
+
+    def _remove(self, spawnpoint_id):
+        spawnpoint = self.spawnpoints.pop(spawnpoint_id, None)
+        if spawnpoint == None:
+            return
+
+        cell = self.user_index.get_cell(spawnpoint.latitude, spawnpoint.longitude)
+        spawnpoint_ids = self.cells[cell]
+        spawnpoint_ids.discard(spawnpoint_id)
+        if len(spawnpoint_ids) == 0:
+            del self.cells[cell]
+
+        for chat_id in spawnpoint.nearby:
+            spawnpoint_ids = self.members[chat_id]
+            spawnpoint_ids.discard(spawnpoint_id)
+            if len(spawnpoint_ids) == 0:
+                del self.members[chat_id]
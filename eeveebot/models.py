@@ -2,6 +2,7 @@ import logging
 
 from datetime import datetime
 
+from flask import request
 from peewee import SqliteDatabase, Model, DoubleField, BooleanField, CharField, SmallIntegerField, BigIntegerField, DateTimeField, ForeignKeyField, CompositeKey, Proxy
 from playhouse.flask_utils import FlaskDB
 from playhouse.pool import PooledMySQLDatabase
@@ -13,15 +14,54 @@ from .utils import get_args
 log = logging.getLogger(__name__)
 
 args = get_args()
-flaskDb = FlaskDB()
+
+class RouteFlaskDB(FlaskDB):
+    """
+    FlaskDB that leaves out the routes that never use the database, like the
+    webhooks. Under --server gevent all requests run on one thread, so they
+    would share, leak and close each other's thread-local connection.
+    """
+    def __init__(self, excluded_routes=()):
+        super(RouteFlaskDB, self).__init__()
+        self.excluded_routes = set(excluded_routes)
+        
+    def connect_db(self):
+        if request.endpoint not in self.excluded_routes:
+            super(RouteFlaskDB, self).connect_db()
+            
+    def close_db(self, exc):
+        if request.endpoint not in self.excluded_routes:
+            super(RouteFlaskDB, self).close_db(exc)
+
+flaskDb = RouteFlaskDB(excluded_routes=['post_update', 'post_telegram_update', 'test', 'get_stats'])
 
 class MyRetryDB(RetryOperationalError, PooledMySQLDatabase):
     pass
     
+def get_db_connections():
+    """
+    Connections the pool needs: the worker threads keep theirs open for as
+    long as they run, so one for each thread that queries the database.
+    """
+    # The main thread, which loads the indexes, plus two for requests
+    connections = 3
+    
+    connections += max(args.update_threads, 1)
+    connections += max(args.bot_threads, 1)
+    
+    # PruneThread and FlushThread
+    connections += 2
+    
+    # GeocoderThreads and SweepThread
+    if args.gmaps_key or args.geocoder_backend == 'offline':
+        connections += max(args.geocoder_threads, 1) + 1
+    
+    return connections
+    
 def init_database(app):
     if args.db_type == 'mysql':
         log.info('Connecting to MySQL database on %s:%i', args.db_host, args.db_port)
-        connections = args.db_max_connections
+        connections = args.db_max_connections or get_db_connections()
         db = MyRetryDB(
             args.db_name,
             user=args.db_user,
@@ -0,0 +1,196 @@
+import heapq
+import time
+
+from collections import deque
+from itertools import count
+from Queue import Queue, Full
+
+class BatchQueue(Queue):
+    """
+    Queue that takes a whole batch of items under a single lock. When it is
+    bounded and a batch does not fit, the items with the lowest shed_key are
+    dropped to make room, whether they were queued already or not.
+    
+    Queued items are also kept in a heap on their shed_key, so shedding only
+    looks at the lowest ones. Shed items are skipped when they reach the
+    front of the queue.
+    """
+    def __init__(self, maxsize=0, shed_key=None):
+        self.shed_key = shed_key
+        Queue.__init__(self, maxsize)
+
+    def _init(self, maxsize):
+        Queue._init(self, maxsize)
+        self.heap = []
+        self.shed = set()
+        self.seq = 0
+
+    def _qsize(self, len=len):
+        return len(self.queue) - len(self.shed)
+
+    def _put(self, item):
+        self.seq += 1
+        self.queue.append((self.seq, item))
+        
+        if self.maxsize > 0:
+            heapq.heappush(self.heap, (self.shed_key(item), self.seq))
+
+    def _get(self):
+        while True:
+            seq, item = self.queue.popleft()
+            
+            if seq in self.shed:
+                self.shed.discard(seq)
+            else:
+                return item
+
+    def get_lowest(self):
+        # Entries below the front of the queue were taken by a consumer
+        while len(self.heap) > 0 and (len(self.queue) == 0 or self.heap[0][1] < self.queue[0][0]):
+            heapq.heappop(self.heap)
+            
+        if len(self.heap) == 0:
+            return None
+            
+        return self.heap[0]
+
+    def compact(self):
+        # Keeps the heap and the shed items from outgrowing the queue
+        if len(self.shed) > self.maxsize:
+            self.queue = deque(entry for entry in self.queue if entry[0] not in self.shed)
+            self.shed = set()
+            
+        if len(self.heap) > 2 * len(self.queue) + 64:
+            self.heap = [(self.shed_key(item), seq) for seq, item in self.queue if seq not in self.shed]
+            heapq.heapify(self.heap)
+
+    def put_many(self, items):
+        """
+        Puts all the items in the queue while holding its lock only once,
+        and returns how many items had to be shed from the queue and from
+        the batch.
+        """
+        if len(items) == 0:
+            return 0, 0
+
+        self.not_full.acquire()
+        try:
+            size = self._qsize()
+            shed_queued = 0
+            shed_incoming = set()
+            
+            overflow = size + len(items) - self.maxsize
+            if self.maxsize > 0 and overflow > 0:
+                incoming = sorted(range(len(items)), key=lambda i: self.shed_key(items[i]))
+                
+                for x in range(overflow):
+                    lowest = self.get_lowest()
+                    
+                    if (len(shed_incoming) < len(incoming) and
+                        (lowest == None or self.shed_key(items[incoming[len(shed_incoming)]]) < lowest[0])):
+                        shed_incoming.add(incoming[len(shed_incoming)])
+                    else:
+                        heapq.heappop(self.heap)
+                        self.shed.add(lowest[1])
+                        shed_queued += 1
+                        
+            for i, item in enumerate(items):
+                if i not in shed_incoming:
+                    self._put(item)
+                    
+            if self.maxsize > 0:
+                self.compact()
+                    
+            self.unfinished_tasks += self._qsize() - size
+            self.not_empty.notify(len(items))
+            
+            return shed_queued, len(shed_incoming)
+        finally:
+            self.not_full.release()
+
+class DeadlineQueue(Queue):
+    """
+    Queue of (deadline, item) pairs that hands out the earliest deadline
+    first. Consumers are expected to discard items whose deadline passed.
+    """
+    def _init(self, maxsize):
+        self.queue = []
+        self.counter = count()
+
+    def _qsize(self, len=len):
+        return len(self.queue)
+
+    def _put(self, item):
+        deadline, value = item
+        heapq.heappush(self.queue, (deadline, next(self.counter), value))
+
+    def _get(self):
+        deadline, seq, value = heapq.heappop(self.queue)
+        return deadline, value
+
+class KeyedDeadlineQueue(DeadlineQueue):
+    """
+    DeadlineQueue of (deadline, (key, item)) pairs that holds each key only
+    once. Putting a key that is already queued moves it up if the deadline
+    is earlier, and does nothing otherwise.
+    """
+    def _init(self, maxsize):
+        DeadlineQueue._init(self, maxsize)
+        self.deadlines = {}
+
+    def _qsize(self, len=len):
+        return len(self.deadlines)
+
+    def put(self, item, block=True, timeout=None):
+        """
+        Like Queue.put, but only a key that wasn't queued yet counts as a new
+        task, or join() would wait for task_done() calls that never come.
+        """
+        deadline, (key, value) = item
+
+        self.not_full.acquire()
+        try:
+            if key not in self.deadlines and self.maxsize > 0:
+                if block == False:
+                    if self._qsize() >= self.maxsize:
+                        raise Full
+                elif timeout == None:
+                    while self._qsize() >= self.maxsize:
+                        self.not_full.wait()
+                else:
+                    end = time.time() + timeout
+                    while self._qsize() >= self.maxsize:
+                        remaining = end - time.time()
+                        if remaining <= 0:
+                            raise Full
+                        self.not_full.wait(remaining)
+
+            # Waiting may have let the same key in
+            new = key not in self.deadlines
+
+            self._put(item)
+
+            if new == True:
+                self.unfinished_tasks += 1
+                self.not_empty.notify()
+        finally:
+            self.not_full.release()
+
+    def _put(self, item):
+        deadline, (key, value) = item
+
+        current = self.deadlines.get(key)
+        if current != None and current <= deadline:
+            return
+
+        self.deadlines[key] = deadline
+        heapq.heappush(self.queue, (deadline, next(self.counter), (key, value)))
+
+    def _get(self):
+        # Skip the entries of keys that were moved up since
+        while True:
+            deadline, seq, (key, value) = heapq.heappop(self.queue)
+
+            if self.deadlines.get(key) == deadline:
+                del self.deadlines[key]
+                return deadline, value
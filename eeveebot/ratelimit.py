@@ -0,0 +1,221 @@
+import calendar
+import json
+import logging
+import os
+import time
+
+from threading import Lock
+
+log = logging.getLogger(__name__)
+
+def get_pacific_offset(now):
+    """
+    Seconds between US Pacific Time and UTC at the given timestamp: daylight
+    saving time runs from 2 AM of the second Sunday of March to 2 AM of the
+    first Sunday of November.
+    """
+    year = time.gmtime(now).tm_year
+
+    march = 8 + (6 - calendar.weekday(year, 3, 8)) % 7
+    november = 1 + (6 - calendar.weekday(year, 11, 1)) % 7
+
+    # 2 AM PST and 2 AM PDT, in UTC
+    start = calendar.timegm((year, 3, march, 10, 0, 0))
+    end = calendar.timegm((year, 11, november, 9, 0, 0))
+
+    if start <= now < end:
+        return -7 * 3600
+    return -8 * 3600
+
+def get_pacific_day(now):
+    """
+    Returns the day in US Pacific Time, in days since the epoch, and when it
+    ends.
+    """
+    day = int((now + get_pacific_offset(now)) // 86400)
+
+    # Midnight is never when the clocks change, but it may be on the other
+    # side of a change
+    end = (day + 1) * 86400 - get_pacific_offset(now)
+    end = (day + 1) * 86400 - get_pacific_offset(end)
+
+    return day, end
+
+class TokenBucket(object):
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.time()
+        self.paused_until = 0
+
+    def refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait_time(self, now):
+        """
+        Seconds until a token is available, without taking it.
+        """
+        if now < self.paused_until:
+            return self.paused_until - now
+
+        self.refill(now)
+
+        if self.tokens >= 1:
+            return 0
+
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self.refill(now)
+        self.tokens -= 1
+
+    def pause(self, now, seconds):
+        # Nothing goes out until the pause is over, and then just one send
+        self.paused_until = max(self.paused_until, now + seconds)
+        self.tokens = min(1, self.capacity)
+        self.updated = self.paused_until
+
+    def is_full(self, now):
+        return now >= self.paused_until and self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+class RateLimiter(object):
+    """
+    A global token bucket plus one bucket per chat, matching Telegram's
+    limits of about 30 messages per second overall and 1 per second per chat.
+    """
+    def __init__(self, rate, chat_rate, chat_burst=3):
+        self.bucket = TokenBucket(rate, rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_buckets = {}
+        self.lock = Lock()
+
+    def get_chat_bucket(self, chat_id, now):
+        bucket = self.chat_buckets.get(chat_id)
+
+        if bucket == None:
+            if len(self.chat_buckets) > 10000:
+                self.prune(now)
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self.chat_buckets[chat_id] = bucket
+
+        return bucket
+
+    def reserve(self, chat_id):
+        """
+        Takes a token from both the global and the chat bucket and returns
+        (0, 0), or returns how many seconds the chat and the global bucket
+        need before trying again.
+        """
+        now = time.time()
+
+        self.lock.acquire()
+        try:
+            chat_bucket = self.get_chat_bucket(chat_id, now)
+
+            chat_wait = chat_bucket.wait_time(now)
+            global_wait = self.bucket.wait_time(now)
+            if chat_wait > 0 or global_wait > 0:
+                return chat_wait, global_wait
+
+            chat_bucket.take(now)
+            self.bucket.take(now)
+
+            return 0, 0
+        finally:
+            self.lock.release()
+
+    def pause(self, chat_id, seconds):
+        # Telegram's flood control applies to the whole bot, not just the
+        # chat that got the 429
+        now = time.time()
+
+        self.lock.acquire()
+        try:
+            self.get_chat_bucket(chat_id, now).pause(now, seconds)
+            self.bucket.pause(now, seconds)
+        finally:
+            self.lock.release()
+
+    def prune(self, now):
+        # Buckets that refilled completely behave exactly like new ones
+        for chat_id in [chat_id for chat_id, bucket in self.chat_buckets.iteritems() if bucket.is_full(now)]:
+            del self.chat_buckets[chat_id]
+
+class QuotaLimiter(object):
+    """
+    A token bucket plus a daily quota that resets at midnight Pacific Time,
+    like the limits of the Google Maps APIs. A daily quota of 0 means no
+    daily limit. The requests made today are kept in the file at path, if
+    any, so a restart doesn't start the count over.
+    """
+    def __init__(self, rate, daily, path=None):
+        self.bucket = TokenBucket(rate, max(rate, 1))
+        self.daily = daily
+        self.path = path
+        self.day = None
+        self.used = 0
+        self.lock = Lock()
+
+        self.load()
+
+    def load(self):
+        if self.path == None or not os.path.exists(self.path):
+            return
+
+        try:
+            with open(self.path, 'rb') as f:
+                saved = json.load(f)
+        except (IOError, ValueError) as e:
+            log.warning('Could not read the geocoding quota from %s: %s', self.path, e)
+            return
+
+        day, end = get_pacific_day(time.time())
+        if saved.get('day') == day:
+            self.day = day
+            self.used = saved.get('used', 0)
+            log.info('%d geocoding requests were already made today.', self.used)
+
+    def save(self):
+        if self.path == None:
+            return
+
+        # Written aside and renamed, so a crash never leaves half a file
+        try:
+            with open(self.path + '.tmp', 'wb') as f:
+                json.dump({'day': self.day, 'used': self.used}, f)
+            os.rename(self.path + '.tmp', self.path)
+        except (IOError, OSError) as e:
+            log.warning('Could not save the geocoding quota to %s: %s', self.path, e)
+
+    def reserve(self):
+        """
+        Takes a token and returns 0, or returns how many seconds to wait
+        before trying again.
+        """
+        now = time.time()
+
+        self.lock.acquire()
+        try:
+            day, end = get_pacific_day(now)
+            if day != self.day:
+                self.day = day
+                self.used = 0
+
+            if self.daily > 0 and self.used >= self.daily:
+                return end - now
+
+            wait = self.bucket.wait_time(now)
+            if wait > 0:
+                return wait
+
+            self.bucket.take(now)
+            self.used += 1
+            self.save()
+
+            return 0
+        finally:
+            self.lock.release()
@@ -0,0 +1,84 @@
+import time
+
+from threading import Lock
+
+# Nothing stays on the map longer than this (in seconds)
+MAX_TTL = 2 * 60 * 60
+
+class SeenStore(object):
+    """
+    Remembers the encounters that were already handled until they despawn.
+    
+    Entries are kept in a timer wheel with one-second buckets keyed by their
+    disappear_time, so inserting, looking up and expiring are all O(1). Once
+    max_size entries are stored, the ones closest to despawning are evicted.
+    """
+    def __init__(self, stats, max_size=500000):
+        self.stats = stats
+        self.max_size = max_size
+        self.entries = {}
+        self.buckets = {}
+        self.cursor = int(time.time())
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get_key(self, spawnpoint_id, encounter_id):
+        # A 64-bit hash instead of the full id strings
+        return hash((str(spawnpoint_id), str(encounter_id)))
+
+    def add(self, spawnpoint_id, encounter_id, disappear_time):
+        """
+        Returns False if this encounter was already seen, True otherwise.
+        """
+        key = self.get_key(spawnpoint_id, encounter_id)
+        now = time.time()
+
+        self.lock.acquire()
+        try:
+            self.expire(now)
+
+            if key in self.entries:
+                self.stats.incr('seen_duplicates')
+                return False
+
+            second = int(min(disappear_time, now + MAX_TTL))
+
+            # Already gone, nothing left to deduplicate
+            if second < self.cursor:
+                return True
+
+            self.entries[key] = second
+            self.buckets.setdefault(second, []).append(key)
+
+            while len(self.entries) > self.max_size:
+                self.evict()
+
+            return True
+        finally:
+            self.lock.release()
+
+    def expire(self, now):
+        expired = 0
+
+        while self.cursor <= now:
+            for key in self.buckets.pop(self.cursor, ()):
+                del self.entries[key]
+                expired += 1
+            self.cursor += 1
+
+        if expired > 0:
+            self.stats.incr('seen_expired', expired)
+
+    def evict(self):
+        second = self.cursor
+        while second not in self.buckets:
+            second += 1
+
+        bucket = self.buckets[second]
+        del self.entries[bucket.pop()]
+        if len(bucket) == 0:
+            del self.buckets[second]
+
+        self.stats.incr('seen_evicted')
@@ -0,0 +1,35 @@
+from threading import Lock
+
+class Stats(object):
+    """
+    Thread-safe counters, served as JSON on /stats.
+    """
+    def __init__(self):
+        self.counters = {}
+        self.lock = Lock()
+
+    def incr(self, name, value=1):
+        self.lock.acquire()
+        try:
+            self.counters[name] = self.counters.get(name, 0) + value
+        finally:
+            self.lock.release()
+
+    def observe(self, name, value):
+        """
+        Records a sample, keeping its count, sum and max.
+        """
+        self.lock.acquire()
+        try:
+            self.counters[name + '_count'] = self.counters.get(name + '_count', 0) + 1
+            self.counters[name + '_sum'] = self.counters.get(name + '_sum', 0) + value
+            self.counters[name + '_max'] = max(self.counters.get(name + '_max', 0), value)
+        finally:
+            self.lock.release()
+
+    def snapshot(self):
+        self.lock.acquire()
+        try:
+            return dict(self.counters)
+        finally:
+            self.lock.release()
@@ -1,72 +1,46 @@
-from datetime import datetime
+import calendar
 import logging
 
+from datetime import datetime
 from threading import Thread
 
-from .utils import get_args, get_outer_square, get_pokemon_name, format_time_left, get_distance
-from .models import User, UserAlert, Location
+from .utils import get_args, get_pokemon_name, format_time_left
+from .alarm import Sighting
+from .geocoder import get_priority, set_address
 
 log = logging.getLogger(__name__)
 
 args = get_args()
 
 class UpdateThread(Thread):
-    def __init__(self, app):
+    def __init__(self, app, queue):
         super(UpdateThread, self).__init__()
         self.app = app
-        self.queue = app.update_queue
+        self.queue = queue
 
     def run(self):
         while True:
             try:
                 # Loop the queue
-                for x in range(5000):
+                while True:
                     message_type, message = self.queue.get()
                     
+                    # Messages were validated by the webhook
                     if message_type == 'pokemon':
-                        if ('pokemon_id' not in message or
-                            'encounter_id' not in message or
-                            'disappear_time' not in message or
-                            'latitude' not in message or
-                            'longitude' not in message):
-                            log.debug('Invalid pokemon message. Ignoring.')
-                        else:
-                            self.trigger_pokemon(message)
+                        self.trigger_pokemon(message)
                     
                     if self.queue.qsize() > 50:
                         log.warning('Update queue is > 50 (@%d); try increasing --update-threads', self.queue.qsize())
                     
                     self.queue.task_done()
-                    
-                # Clean up expired sightings
-                log.info('Cleaning up expired sightings...')
-                self.app.seen_lock.acquire()
-                try:
-                    for key in self.app.seen:
-                        disappear_time = datetime.utcfromtimestamp(self.app.seen[key])
-                        seconds_left = (disappear_time - datetime.utcnow()).total_seconds()
-                        
-                        if seconds_left <= 0:
-                            self.app.seen.popitem()
-                        else:
-                            break
-                finally:
-                    self.app.seen_lock.release()
             except KeyboardInterrupt:
                 break
             except Exception as e:
                 log.exception('Exception in UpdateThread: %s', e)
                 
     def trigger_pokemon(self, message):   
-        self.app.seen_lock.acquire()
-        try:
-            key = str(message['spawnpoint_id']) + ':' + str(message['encounter_id'])
-            if self.app.seen.get(key):
-                return
-        
-            self.app.seen[key] = message['disappear_time']
-        finally:
-            self.app.seen_lock.release()
+        if self.app.seen.add(message['spawnpoint_id'], message['encounter_id'], message['disappear_time']) == False:
+            return
         
         disappear_time = datetime.utcfromtimestamp(message['disappear_time'])      
         pokemon_id = message['pokemon_id']
@@ -78,9 +52,23 @@ class UpdateThread(Thread):
         if seconds_left <= 30:
             return
 
-        location, created = Location.get_or_create(latitude=latitude, longitude=longitude)
+        location, created = self.app.location_cache.get_or_create(latitude, longitude)
+        
+        if created == True and self.app.geocoder != None:
+            if self.app.geocoder.limited == False:
+                # Local lookups are cheap enough to do right away
+                set_address(location, self.app.geocoder.reverse(latitude, longitude))
+            else:
+                # New locations right next to a known one are resolved on the
+                # spot; the geocoder counts the miss if it has to ask Google
+                self.app.address_cache.snap(location, count_miss=False)
+        
+        if location.resolved == False and self.app.geocoder != None:
+            key = self.app.location_cache.get_key(latitude, longitude)
+            self.app.geocode_queue.put((get_priority(message['disappear_time']), (key, location)))
 
         pokemon_event = {
+            'spawnpoint_id': message['spawnpoint_id'],
             'pokemon_id': pokemon_id,
             'pokemon_name': get_pokemon_name(pokemon_id),
             'disappear_time': disappear_time,
@@ -90,7 +78,10 @@ class UpdateThread(Thread):
         }
         
         if location.resolved == True:
-            pokemon_event['address'] = '%s, %s' % (location.street_name, location.street_number)
+            if location.street_number != None:
+                pokemon_event['address'] = '%s, %s' % (location.street_name, location.street_number)
+            else:
+                pokemon_event['address'] = location.street_name
             pokemon_event['sublocality'] = location.sublocality
             pokemon_event['locality'] = location.locality
        
@@ -103,32 +94,33 @@ class UpdateThread(Thread):
         kwargs['dont'] = self.process_catchable_pokemon(**kwargs)
         kwargs['dont'] = self.process_nearby_pokemon(**kwargs)
 
-    def process_catchable_pokemon(self, dont, pokemon_id, pokemon_name, disappear_time, time_left, latitude, longitude, address=None, sublocality=None, locality=None):
-        box = get_outer_square((latitude, longitude), 70)
-        
-        query = (User
-                 .select(User)
-                 .where(
-                    (User.enabled == True) &
-                    (User.report_catchable == True) &
-                    ((User.latitude >= box['min_latitude']) &
-                     (User.latitude <= box['max_latitude']) &
-                     (User.longitude >= box['min_longitude']) &
-                     (User.longitude <= box['max_longitude']))))
-                     
-        
-        chats = set(user.chat_id for user in query if get_distance((user.latitude, user.longitude), (latitude, longitude)) <= 70)
+    def queue_alarm(self, disappear_time, chats, method, args):
+        deadline = calendar.timegm(disappear_time.utctimetuple())
+        self.app.alarm_queue.put((deadline, (chats, method, args)))
+        
+    def queue_sighting(self, chats, title, pokemon_name, disappear_time, address, latitude, longitude):
+        deadline = calendar.timegm(disappear_time.utctimetuple())
+        self.app.coalesce_queue.put((chats, Sighting(title, pokemon_name, deadline, address, latitude, longitude)))
+        
+    def process_catchable_pokemon(self, dont, spawnpoint_id, pokemon_id, pokemon_name, disappear_time, time_left, latitude, longitude, address=None, sublocality=None, locality=None):
+        spawnpoint = self.app.spawnpoint_cache.get(spawnpoint_id, latitude, longitude)
+        
+        chats = set(spawnpoint.catchable)
         chats -= dont
         
         if len(chats) == 0:
             return set()
             
+        if args.coalesce_window > 0:
+            self.queue_sighting(chats, '{} bem do seu lado!'.format(pokemon_name), pokemon_name, disappear_time, address, latitude, longitude)
+            return chats
+            
         targs = {
             'text': '<b>{} bem do seu lado!</b>\n{} restantes.'.format(pokemon_name, time_left),
             'parse_mode': 'HTML'
         }
             
-        self.app.alarm_queue.put((chats, 'sendMessage', targs))
+        self.queue_alarm(disappear_time, chats, 'sendMessage', targs)
         
         targs = {
             'title': pokemon_name,
@@ -138,36 +130,34 @@ class UpdateThread(Thread):
             'disable_notification': 'True'
         }
         
-        self.app.alarm_queue.put((chats, 'sendVenue', targs))
+        self.queue_alarm(disappear_time, chats, 'sendVenue', targs)
         
         return chats
         
-    def process_nearby_pokemon(self, dont, pokemon_id, pokemon_name, disappear_time, time_left, latitude, longitude, address=None, sublocality=None, locality=None):
-        box = get_outer_square((latitude, longitude), 1000)
-        
-        query = (User
-                 .select(User)
-                 .join(UserAlert)
-                 .where(
-                    (User.enabled == True) &
-                    (UserAlert.pokemon_id == pokemon_id) &
-                    ((User.latitude >= box['min_latitude']) &
-                     (User.latitude <= box['max_latitude']) &
-                     (User.longitude >= box['min_longitude']) &
-                     (User.longitude <= box['max_longitude']))))
-        
-        chats = set(user.chat_id for user in query if get_distance((user.latitude, user.longitude), (latitude, longitude)) <= 1000)
+    def process_nearby_pokemon(self, dont, spawnpoint_id, pokemon_id, pokemon_name, disappear_time, time_left, latitude, longitude, address=None, sublocality=None, locality=None):
+        spawnpoint = self.app.spawnpoint_cache.get(spawnpoint_id, latitude, longitude)
+        
+        chats = set(spawnpoint.nearby)
         chats -= dont
         
         if len(chats) == 0:
             return chats
         
+        chats = self.app.alert_index.match(pokemon_id, chats)
+        
+        if len(chats) == 0:
+            return chats
+        
+        if args.coalesce_window > 0:
+            self.queue_sighting(chats, '{} encontrado!'.format(pokemon_name), pokemon_name, disappear_time, address, latitude, longitude)
+            return chats
+            
         targs = {
             'text': '<b>{} encontrado!</b>\n{} restantes.'.format(pokemon_name, time_left),
             'parse_mode': 'HTML'
         }
         
-        self.app.alarm_queue.put((chats, 'sendMessage', targs))
+        self.queue_alarm(disappear_time, chats, 'sendMessage', targs)
     
         targs = {
             'title': pokemon_name,
@@ -177,9 +167,9 @@ class UpdateThread(Thread):
             'disable_notification': 'True'
         }
         
-        self.app.alarm_queue.put((chats, 'sendVenue', targs))
+        self.queue_alarm(disappear_time, chats, 'sendVenue', targs)
             
-    def process_channel_pokemon(self, dont, pokemon_id, pokemon_name, disappear_time, time_left, latitude, longitude, address=None, sublocality=None, locality=None):
+    def process_channel_pokemon(self, dont, spawnpoint_id, pokemon_id, pokemon_name, disappear_time, time_left, latitude, longitude, address=None, sublocality=None, locality=None):
         if args.telegram_channel == None or pokemon_id not in args.channel_pokemon:
             return set()
             
@@ -197,7 +187,7 @@ class UpdateThread(Thread):
             'parse_mode': 'HTML',
             'reply_markup': None
         }
-        self.app.alarm_queue.put((chats, 'sendMessage', targs))
+        self.queue_alarm(disappear_time, chats, 'sendMessage', targs)
         
         targs = {
             'title': pokemon_name,
@@ -207,6 +197,6 @@ class UpdateThread(Thread):
             'disable_notification': 'True'
         }
         
-        self.app.alarm_queue.put((chats, 'sendVenue', targs))
+        self.queue_alarm(disappear_time, chats, 'sendVenue', targs)
         
         return chats
\ No newline at end of file
@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
 import logging
+import math
 import os
 import re
 import sys
 import time
+import unicodedata
 
 from datetime import datetime
 
@@ -11,6 +13,7 @@ import configargparse
 import googlemaps
 from googlemaps.exceptions import ApiError, HTTPError, Timeout, TransportError
 import geopy.distance
+import numpy as np
 
 log = logging.getLogger(__name__)
      
@@ -36,6 +39,8 @@ def get_args():
     parser = configargparse.ArgParser(default_config_files=[configpath], auto_env_var_prefix='EEVEEBOT_')
     parser.add_argument('-tk', '--telegram-key', required=True,
                         help='Telegram Key')
+    parser.add_argument('-tw', '--telegram-webhook',
+                        help='Public URL to receive Telegram updates on instead of polling (e.g. https://example.com/my-secret-path)')
     parser.add_argument('-gk', '--gmaps-key',
                         help='Google Maps Geocode API Server Key')
     parser.add_argument('-tc', '--telegram-channel',
@@ -48,6 +53,8 @@ def get_args():
                         help='Set web server listening host')
     parser.add_argument('-P', '--port', type=int, default=4000,
                         help='Set web server listening port')
+    parser.add_argument('--server', choices=['flask', 'gevent'], default='flask',
+                        help='Web server to use: flask (one thread per request, default) or gevent (event loop, requires gevent)')
     parser.add_argument('-t', '--token',
                         help='Set web hook authentication token')
     parser.add_argument('--db', default='eeveebot.db', metavar='filename.db',
@@ -64,8 +71,46 @@ def get_args():
                         help='IP or hostname for the database')
     parser.add_argument('--db-port', type=int, default=3306,
                         help='Port for the database')
-    parser.add_argument('--db-max-connections', type=int, default=5,
-                        help='Max connections (per thread) for the database')
+    parser.add_argument('--db-max-connections', type=int,
+                        help='Max connections to the database, shared by all threads (default: one per thread that uses it)')
+    parser.add_argument('-ut', '--update-threads', type=int, default=1,
+                        help='Number of threads processing webhook updates (default: 1)')
+    parser.add_argument('-uq', '--update-queue-size', type=int, default=10000,
+                        help='Max webhook updates waiting to be processed before shedding (default: 10000)')
+    parser.add_argument('--location-cache-size', type=int, default=20000,
+                        help='Number of spawnpoint locations kept in memory (default: 20000)')
+    parser.add_argument('--spawnpoint-cache-size', type=int, default=20000,
+                        help='Number of spawnpoints whose nearby users are kept in memory (default: 20000)')
+    parser.add_argument('--user-cache-size', type=int, default=20000,
+                        help='Number of users kept in memory (default: 20000)')
+    parser.add_argument('--coalesce-window', type=int, default=0,
+                        help='Merge the alerts a user gets within this many seconds into one message (default: 0, disabled)')
+    parser.add_argument('-at', '--alarm-threads', type=int, default=4,
+                        help='Number of threads sending Telegram alarms (default: 4)')
+    parser.add_argument('--telegram-rate', type=float, default=30,
+                        help='Max Telegram messages per second (default: 30)')
+    parser.add_argument('--telegram-chat-rate', type=float, default=1,
+                        help='Max Telegram messages per second to a single chat (default: 1)')
+    parser.add_argument('-bt', '--bot-threads', type=int, default=4,
+                        help='Number of threads handling bot commands (default: 4)')
+    parser.add_argument('--user-flush-interval', type=int, default=60,
+                        help='Seconds between writes of the users\' last message time (default: 60)')
+    parser.add_argument('--geocoder-backend', choices=['google', 'offline'], default='google',
+                        help='Where addresses come from: google (requires --gmaps-key, default) or offline (requires --geocoder-dataset)')
+    parser.add_argument('--geocoder-dataset', metavar='addresses.csv',
+                        help='CSV of latitude, longitude, street_name, street_number, sublocality and locality for the offline geocoder')
+    parser.add_argument('-gt', '--geocoder-threads', type=int, default=2,
+                        help='Number of threads resolving addresses (default: 2)')
+    parser.add_argument('--geocoder-rate', type=float, default=10,
+                        help='Max geocoding requests per second (default: 10)')
+    parser.add_argument('--geocoder-daily-quota', type=int, default=2500,
+                        help='Max geocoding requests per day, 0 for no limit (default: 2500)')
+    parser.add_argument('--geocoder-quota-file', default='geocoder_quota.json', metavar='filename.json',
+                        help='Where the geocoding requests made today are kept across restarts (default: geocoder_quota.json)')
+    parser.add_argument('--snap-distance', type=float, default=20,
+                        help='Reuse the address of a geocoded location this many meters away, 0 to always geocode (default: 20)')
+    parser.add_argument('--address-cache-size', type=int, default=20000,
+                        help='Number of 100 m cells of addresses kept in memory for --snap-distance (default: 20000)')
     parser.add_argument('-v', '--verbose', nargs='?', const='nofile', default=False, metavar='filename.log',
                         help='Show debug messages.')
     parser.set_defaults(DEBUG=False)
@@ -110,22 +155,90 @@ def get_new_coords(init_loc, distance, bearing):
     destination = geopy.distance.distance(meters=distance).destination(origin, bearing)
     return (destination.latitude, destination.longitude)
     
+# WGS84 ellipsoid
+EARTH_RADIUS = 6378137.0
+EARTH_E2 = 6.69437999014e-3
+
+# Bounding box deltas are cached per band of this many degrees of latitude
+LATITUDE_BAND = 0.1
+
+@memoize
+def get_square_deltas(radius, band):
+    """
+    Given a radius (in meters) and a latitude band, this will calculate the
+    latitude and longitude deltas (in degrees) of a square that contains
+    that radius around any point inside the band.
+    """
+    # The meridional radius of curvature is smallest at the equator
+    delta_latitude = math.degrees(radius / (EARTH_RADIUS * (1 - EARTH_E2)))
+    
+    # ...and parallels are shortest at the edge of the square closest to a pole
+    latitude = max(abs(band), abs(band + 1)) * LATITUDE_BAND + delta_latitude
+    latitude = math.radians(min(latitude, 89.9))
+    n = EARTH_RADIUS / math.sqrt(1 - EARTH_E2 * math.sin(latitude) ** 2)
+    delta_longitude = math.degrees(radius / (n * math.cos(latitude)))
+    
+    return (delta_latitude, delta_longitude)
+    
 def get_outer_square(center, radius):
-    top_center = get_new_coords(center, radius, 90)
-    top_left = get_new_coords(top_center, radius, 180)
-    bottom_center = get_new_coords(center, radius, 270)
-    bottom_right = get_new_coords(bottom_center, radius, 0)
+    band = int(math.floor(center[0] / LATITUDE_BAND))
+    delta_latitude, delta_longitude = get_square_deltas(radius, band)
     
     return {
-        'min_latitude': top_left[0],
-        'max_latitude': bottom_right[0],
-        'min_longitude': bottom_right[1],
-        'max_longitude': top_left[1]
+        'min_latitude': center[0] - delta_latitude,
+        'max_latitude': center[0] + delta_latitude,
+        'min_longitude': center[1] - delta_longitude,
+        'max_longitude': center[1] + delta_longitude
     }
     
 def get_distance(a, b):
     return geopy.distance.distance(a, b).meters
     
+
+def get_distances(center, latitudes, longitudes):
+    """
+    Given a center lat/lng and arrays of latitudes and longitudes, this will
+    calculate the distance (in meters) from the center to each point.
+    
+    Points are projected on the plane tangent to the WGS84 ellipsoid at their
+    mid-latitude, which stays within 1 cm of the geodesic distance for
+    anything closer than a few kilometers.
+    """
+    latitudes = np.radians(np.asarray(latitudes, dtype=np.float64))
+    longitudes = np.radians(np.asarray(longitudes, dtype=np.float64))
+    latitude = np.radians(center[0])
+    longitude = np.radians(center[1])
+    
+    mid_latitude = (latitudes + latitude) / 2
+    sin2 = np.sin(mid_latitude) ** 2
+    w = np.sqrt(1 - EARTH_E2 * sin2)
+    
+    # meridional and prime vertical radii of curvature
+    m = EARTH_RADIUS * (1 - EARTH_E2) / (w ** 3)
+    n = EARTH_RADIUS / w
+    
+    dy = m * (latitudes - latitude)
+    dx = n * np.cos(mid_latitude) * (longitudes - longitude)
+    
+    return np.hypot(dx, dy)
+    
+def get_within_radius(center, latitudes, longitudes, radius):
+    return get_distances(center, latitudes, longitudes) <= radius
+    
+def is_valid_pokemon(message):
+    if not isinstance(message, dict):
+        return False
+        
+    for field in ('spawnpoint_id', 'encounter_id', 'pokemon_id'):
+        if message.get(field) == None:
+            return False
+            
+    for field in ('disappear_time', 'latitude', 'longitude'):
+        if not isinstance(message.get(field), (int, long, float)) or isinstance(message.get(field), bool):
+            return False
+            
+    return True
+    
 def format_time_left(s):
     m, s = divmod(s, 60)
     h, m = divmod(m, 60)
@@ -443,9 +556,101 @@ pokemon_ids = {
     'mew': 151
 }
 
+# Name index, built once: every prefix of at least 3 letters, and every
+# string reachable by deleting up to MAX_EDIT_DISTANCE letters of a name,
+# which is enough to find all names within that edit distance of a typo.
+MIN_PREFIX_LENGTH = 3
+MAX_EDIT_DISTANCE = 2
+MAX_NAME_LENGTH = 20
+
+NON_WORD = re.compile(r'\W+', re.UNICODE)
+
+def normalize_pokemon_name(pokemon_name):
+    if isinstance(pokemon_name, str):
+        pokemon_name = pokemon_name.decode('utf-8', 'ignore')
+        
+    pokemon_name = pokemon_name.replace(u'\u2640', u'f').replace(u'\u2642', u'm')
+    pokemon_name = unicodedata.normalize('NFKD', pokemon_name)
+    pokemon_name = u''.join(c for c in pokemon_name if not unicodedata.combining(c))
+    
+    return NON_WORD.sub(u'', pokemon_name).lower().encode('ascii', 'ignore')[:MAX_NAME_LENGTH]
+    
+def get_deletes(word, distance):
+    deletes = set([word])
+    edge = deletes
+    
+    for x in range(distance):
+        edge = set(w[:i] + w[i + 1:] for w in edge for i in range(len(w)))
+        deletes |= edge
+        
+    return deletes
+    
+def get_edit_distance(a, b):
+    """
+    Optimal string alignment distance: insertions, deletions, substitutions
+    and transpositions of adjacent letters all cost 1.
+    """
+    before = previous = None
+    row = range(len(b) + 1)
+    
+    for i in range(1, len(a) + 1):
+        previous, row = row, [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            row[j] = min(previous[j] + 1, row[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                row[j] = min(row[j], before[j - 2] + 1)
+        before = previous
+        
+    return row[len(b)]
+    
+pokemon_keys = dict((id, name) for name, id in pokemon_ids.iteritems())
+pokemon_prefixes = {}
+pokemon_deletes = {}
+
+for name, id in pokemon_ids.iteritems():
+    for i in range(MIN_PREFIX_LENGTH, len(name) + 1):
+        pokemon_prefixes.setdefault(name[:i], set()).add(id)
+    for delete in get_deletes(name, MAX_EDIT_DISTANCE):
+        pokemon_deletes.setdefault(delete, set()).add(id)
+
 def get_pokemon_id(pokemon_name):
-    pokemon_name = re.sub(r'\W+', '', pokemon_name).lower()
-    return pokemon_ids.get(pokemon_name)
+    pokemon_name = normalize_pokemon_name(pokemon_name)
+    
+    id = pokemon_ids.get(pokemon_name)
+    if id != None:
+        return id
+        
+    # Only a prefix that can't be anything else
+    ids = pokemon_prefixes.get(pokemon_name)
+    if ids != None and len(ids) == 1:
+        return next(iter(ids))
+        
+    return None
+    
+def suggest_pokemon(pokemon_name):
+    """
+    Returns the id of the pokemon whose name is the closest to pokemon_name,
+    if it is within a couple of typos, or None.
+    """
+    pokemon_name = normalize_pokemon_name(pokemon_name)
+    if len(pokemon_name) < MIN_PREFIX_LENGTH:
+        return None
+        
+    # Short names are one typo away from too many others
+    distance = 1 if len(pokemon_name) <= 4 else MAX_EDIT_DISTANCE
+    
+    candidates = set()
+    for delete in get_deletes(pokemon_name, distance):
+        candidates.update(pokemon_deletes.get(delete, ()))
+        
+    best = None
+    for id in candidates:
+        candidate = (get_edit_distance(pokemon_name, pokemon_keys[id]), id)
+        if candidate[0] <= distance and (best == None or candidate < best):
+            best = candidate
+            
+    return best[1] if best != None else None
     
 def get_pokemon(id_or_name):
     id = None
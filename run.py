@@ -4,12 +4,12 @@ logging.basicConfig(format='%(asctime)s [%(threadName)16s][%(module)14s][%(level
 log = logging.getLogger()
 
 from eeveebot.app import EeveeBot
-from eeveebot.models import init_database, create_tables
+from eeveebot.models import init_database, create_tables, get_db_connections
 from eeveebot.utils import get_args
 from eeveebot.update import UpdateThread
-from eeveebot.alarm import AlarmThread
-from eeveebot.bot import BotThread
-from eeveebot.geocoder import GeocoderThread
+from eeveebot.alarm import AlarmThread, SenderThread, CoalesceThread, PruneThread, init_connection_pool
+from eeveebot.bot import BotThread, CommandThread, FlushThread
+from eeveebot.geocoder import GeocoderThread, SweepThread, get_geocoder
 
 def main():
     args = get_args()
@@ -26,31 +26,91 @@ def main():
         log.setLevel(logging.INFO)
 
     
+    if args.db_type == 'mysql' and args.db_max_connections and args.db_max_connections < get_db_connections():
+        log.critical('--db-max-connections must be at least %d with these thread settings.', get_db_connections())
+        return
+    
     app = EeveeBot(__name__)
 
     db = init_database(app)
     create_tables(db)
     
-    update_thread = UpdateThread(app)
-    update_thread.daemon = True
-    update_thread.start()
+    app.user_index.load()
+    app.alert_index.load()
+    
+    app.geocoder = get_geocoder()
+    if app.geocoder != None and app.geocoder.limited == True:
+        app.address_cache.load()
+    
+    for queue in app.update_queues:
+        update_thread = UpdateThread(app, queue)
+        update_thread.daemon = True
+        update_thread.start()
+    
+    init_connection_pool(len(app.send_queues) + len(app.command_queues) + 1)
     
     alarm_thread = AlarmThread(app)
     alarm_thread.daemon = True
     alarm_thread.start()
     
+    prune_thread = PruneThread(app)
+    prune_thread.daemon = True
+    prune_thread.start()
+    
+    if args.coalesce_window > 0:
+        coalesce_thread = CoalesceThread(app)
+        coalesce_thread.daemon = True
+        coalesce_thread.start()
+    
+    for queue in app.send_queues:
+        sender_thread = SenderThread(app, queue)
+        sender_thread.daemon = True
+        sender_thread.start()
+    
     bot_thread = BotThread(app)
     bot_thread.daemon = True
     bot_thread.start()
     
-    if args.gmaps_key:
-        geocoder_thread = GeocoderThread(app)
-        geocoder_thread.daemon = True
-        geocoder_thread.start()
-    else:
-        log.debug('No --gmaps-key, geocoder will not be enabled.')
+    flush_thread = FlushThread(app)
+    flush_thread.daemon = True
+    flush_thread.start()
     
-    if args.verbose:
+    for queue in app.command_queues:
+        command_thread = CommandThread(bot_thread, queue)
+        command_thread.daemon = True
+        command_thread.start()
+    
+    if app.geocoder != None:
+        for x in range(max(args.geocoder_threads, 1)):
+            geocoder_thread = GeocoderThread(app, app.geocoder)
+            geocoder_thread.daemon = True
+            geocoder_thread.start()
+            
+        sweep_thread = SweepThread(app)
+        sweep_thread.daemon = True
+        sweep_thread.start()
+    
+    if args.server == 'gevent':
+        try:
+            from gevent import socket
+            from gevent.pywsgi import WSGIServer, WSGIHandler
+        except ImportError:
+            log.critical('--server gevent requires gevent to be installed.')
+            return
+            
+        class NoDelayHandler(WSGIHandler):
+            def handle(self):
+                # Otherwise each keep-alive response waits ~40 ms for the
+                # client's delayed ACK
+                self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                WSGIHandler.handle(self)
+            
+        # Serves every connection from a single event loop, with keep-alive,
+        # instead of starting a thread per request. Threads are not patched;
+        # the webhook routes don't touch the database, see RouteFlaskDB.
+        log.info('Listening on %s:%d with gevent.', args.host, args.port)
+        WSGIServer((args.host, args.port), app, log=None, handler_class=NoDelayHandler).serve_forever()
+    elif args.verbose:
         app.run(threaded=True, use_reloader=False, debug=True, host=args.host, port=args.port)
     else:
         app.run(threaded=True, use_reloader=False, debug=False, host=args.host, port=args.port)